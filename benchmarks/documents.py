@@ -0,0 +1,233 @@
+"""Synthetic header documents for the benchmarks.
+
+These resemble the documents in the UKIRT header database: string
+values are unicode (as returned by pymongo), some long string values
+still include their FITS comment, and CGS4 files have a number of
+sub-headers in addition to the primary header.  Documents with byte
+string values, or a mixture of both, can also be generated.
+"""
+
+from random import Random
+
+# Cards which all instruments have, with a typical value.
+common_cards = {
+    'AIRTEMP': 2.5,
+    'AMEND': 1.134,
+    'AMSTART': 1.129,
+    'CSOTAU': 0.08,
+    'DATE-END': u'2003-05-17T10:41:22Z',
+    'DATE-OBS': u'2003-05-17T10:40:12Z',
+    'HUMIDITY': 18.0,
+    'OBJECT': u'NGC 6543',
+    'OBSTYPE': u'OBJECT',
+    'PROJECT': u'U/03A/15',
+    'RECIPE': u'JITTER_SELF_FLAT',
+    'STANDARD': False,
+    'TELESCOP': u'UKIRT',
+    'EQUINOX': 2000.0,
+    'RABASE': 17.976,
+    'DECBASE': 66.633,
+    'TRAOFF': 0.0,
+    'TDECOFF': 0.0,
+}
+
+instrument_cards = {
+    'cgs3': {
+        'INSTRUME': u'CGS3',
+        'C3CHOPPR': u'Secondary',
+        'C3FILT': u'8-12UM',
+        'C3GRAT': u'Low',
+        'C3WAVE': 10.0,
+        'MODE': u'LPCGS3',
+        'UTSTART': u'10:40:12',
+        'UTEND': u'10:41:22',
+    },
+    'ircam': {
+        'INSTRUME': u'IRCAM3',
+        'DETECTOR': u'ALADDIN',
+        'FILTER': u'2.122S1',
+        'MAGNIFIE': u'None',
+        'MODE': u'STARE',
+        'RUTSTART': 10.67,
+        'RUTEND': 10.69,
+        'SPD_GAIN': u'Normal',
+    },
+    'michelle': {
+        'INSTRUME': u'Michelle',
+        'CALSELN': u'none',
+        'CAMERA': u'imaging',
+        'INSTMODE': u'imaging',
+        'CTYPE1': u'RA---TAN',
+        'DET_MODE': u'chop',
+        'FILTER': u'F105B53',
+        'GRATNAME': u'LowN',
+        'SLITNAME': u'2_pixels',
+    },
+    'uist': {
+        'INSTRUME': u'UIST',
+        'CAMLENS': u'0.12',
+        'DET_MODE': u'NDSTARE',
+        'FILTER': u'2.122MK',
+        'GRISM': u'',
+        'INSTMODE': u'imaging',
+        'POLARISE': False,
+        'READOUT': u'CDS',
+        'SLITNAME': u'',
+    },
+    'ufti': {
+        'INSTRUME': u'UFTI',
+        'FILTER': u'J98',
+        'MODE': u'NDSTARE',
+        'SPD_GAIN': u'Normal',
+        'WPLANGLE': 0.0,
+        'CTYPE1': u'RA---TAN',
+        'CTYPE2': u'DEC--TAN',
+        'CDELT1': -2.5278e-05,
+        'CDELT2': 2.5278e-05,
+        'CRPIX1': 512.0,
+        'CRPIX2': 512.0,
+        'CROTA2': 0.0,
+    },
+    'cgs4': {
+        'INSTRUME': u'CGS4',
+        'CVF': u'OUT',
+        'DETECTOR': u'fpa046',
+        'DET_MODE': u'NDSTARE',
+        'FILTERS': u'B1',
+        'GORDER': 1,
+        'GRATING': u'40_LPMM',
+        'GLAMBDA': 2.2,
+        'MODE': u'NDSTARE',
+        'RUTSTART': 10.67,
+        'RUTEND': 10.69,
+        'SLIT': u'0.6arcsec',
+    },
+}
+
+# Number of sub-headers (integrations) in a document.
+num_subheaders = {
+    'cgs3': 0,
+    'cgs4': 16,
+    'ircam': 4,
+    'michelle': 8,
+    'uist': 4,
+    'ufti': 0,
+}
+
+filename_prefix = {
+    'cgs3': 'cgs3_',
+    'cgs4': 'c',
+    'ircam': 'i',
+    'michelle': 'm',
+    'uist': 'u',
+    'ufti': 'f',
+}
+
+string_types = ('unicode', 'bytes', 'mixed')
+
+def header_document(instrument, obs=1, seed=0, extra_cards=120,
+                    string_type='unicode'):
+    """Create a synthetic header database document.
+
+    In addition to the cards listed above, each header has
+    ``extra_cards`` filler cards of mixed types, about one in ten
+    string values of which includes a comment as if it had been
+    mangled.
+
+    The ``string_type`` can be "unicode", "bytes" (all string values
+    are byte strings) or "mixed" (each string value is randomly one
+    or the other)."""
+
+    if string_type not in string_types:
+        raise ValueError('Unknown string type: ' + string_type)
+
+    random = Random(seed + obs)
+
+    primary = dict(common_cards)
+    primary.update(instrument_cards[instrument])
+    primary['OBSNUM'] = obs
+
+    if random.random() < 0.2:
+        # Mangled card with an embedded comment.
+        primary['OBJECT'] = u'NGC 6543                / name of object'
+
+    _add_filler(primary, extra_cards, random)
+
+    headers = [primary]
+
+    for i in range(num_subheaders[instrument]):
+        subheader = {
+            'RUTSTART': 10.67 + i * 0.001,
+            'RUTEND': 10.671 + i * 0.001,
+            'DETINCR': 1,
+            'DETNINCR': 2,
+        }
+
+        _add_filler(subheader, extra_cards // 4, random)
+        headers.append(subheader)
+
+    doc = {
+        'filename': u'{}20030517_{:05d}.{}'.format(
+            filename_prefix[instrument], obs,
+            'fits' if instrument == 'ufti' else 'sdf'),
+        'utdate': u'20030517',
+        'obs': obs,
+        'headers': headers,
+    }
+
+    if string_type != 'unicode':
+        for header in headers:
+            _encode_strings(header, string_type == 'mixed', random)
+
+        _encode_strings(doc, string_type == 'mixed', random)
+
+    return doc
+
+def _add_filler(header, number, random):
+    for i in range(number):
+        kind = random.randint(0, 3)
+        card = 'FILL{:04d}'.format(i)
+
+        if kind == 0:
+            header[card] = random.randint(0, 10000)
+
+        elif kind == 1:
+            header[card] = random.uniform(-1000.0, 1000.0)
+
+        elif kind == 2 and random.random() < 0.1:
+            header[card] = u'= {:.4f}               / value with comment'.format(
+                random.uniform(0.0, 100.0))
+
+        else:
+            header[card] = u'value {}'.format(random.randint(0, 100))
+
+def _encode_strings(header, mixed, random):
+    """Convert the unicode values of a header (or document) to byte
+    strings: all of them, or if ``mixed`` about half of them."""
+
+    for (card, val) in header.items():
+        if type(val) is unicode and not (mixed and random.random() < 0.5):
+            header[card] = val.encode('ascii')
+
+def translated_header(header):
+    """Create a translated header, with the values which
+    HdrTrans would give for a synthetic primary header."""
+
+    return {
+        'RA_BASE': header['RABASE'] * 15.0,
+        'DEC_BASE': header['DECBASE'],
+        'RA_TELESCOPE_OFFSET': header['TRAOFF'],
+        'DEC_TELESCOPE_OFFSET': header['TDECOFF'],
+        'X_REFERENCE_PIXEL': 512.0,
+        'Y_REFERENCE_PIXEL': 512.0,
+        'RA_SCALE': -0.091,
+        'DEC_SCALE': 0.091,
+        'X_LOWER_BOUND': 1,
+        'X_UPPER_BOUND': 1024,
+        'Y_LOWER_BOUND': 1,
+        'Y_UPPER_BOUND': 1024,
+        'ROTATION': 0.0,
+    }
+
+def count_cards(doc):
+    return sum(len(header) for header in doc['headers'])
@@ -0,0 +1,77 @@
+"""In-process fakes for the external services used by IngestRaw.
+
+These allow the ingestion code to be benchmarked without Perl,
+the OMP database or the CAOM-2 repository.
+"""
+
+from datetime import timedelta
+
+from caom2repoClient.caom2repoClient import CAOM2RepoNotFound
+
+from ukirt2caom2 import ProjectInfo
+from ukirt2caom2.translate import TranslationError
+
+from documents import translated_header
+
+class FakeTranslator():
+    """Translator giving fixed translations of synthetic headers."""
+
+    def version(self):
+        return 'fake'
+
+    def translate(self, header):
+        try:
+            return translated_header(header)
+        except KeyError as e:
+            raise TranslationError('Missing card ' + str(e))
+
+    def translate_many(self, headers, cards=None):
+        results = []
+
+        for header in headers:
+            try:
+                results.append(self.translate(header))
+            except TranslationError as e:
+                results.append(e)
+
+        return results
+
+class FakeReleaseCalculator():
+    """Release calculator which releases data after one year."""
+
+    def calculate(self, date):
+        return date + timedelta(days=365)
+
+class FakeOMP():
+    """OMP stand-in which knows every project."""
+
+    def project_info(self, projectid):
+        return ProjectInfo('Title of ' + projectid, 'PI of ' + projectid)
+
+    def project_info_many(self, projectids, chunk_size=100):
+        return dict((x.upper(), self.project_info(x)) for x in projectids)
+
+class FakeRepoClient():
+    """Repository client which stores observations in memory."""
+
+    def __init__(self):
+        self.observations = {}
+
+    def get_xml(self, uri):
+        if uri not in self.observations:
+            raise CAOM2RepoNotFound(uri)
+
+        return self.observations[uri]
+
+    def put_xml(self, uri, xml):
+        self.observations[uri] = xml
+
+    def update_xml(self, uri, xml):
+        if uri not in self.observations:
+            raise CAOM2RepoNotFound(uri)
+
+        self.observations[uri] = xml
+
+    def remove(self, uri):
+        if self.observations.pop(uri, None) is None:
+            raise CAOM2RepoNotFound(uri)
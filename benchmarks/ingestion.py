@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+"""Benchmark of observation ingestion for each instrument.
+
+Synthetic header documents are passed through the steps of
+IngestRaw (normalize, translate, fetch, build, serialize and send)
+using the fakes in fakes.py in place of the external services.
+The time taken by each step, and by each phase of
+ObservationUKIRT.ingest, is reported along with the number of
+observations per second and the peak memory use.  Each instrument is
+measured in a separate process so that its peak memory use can be
+determined.
+
+The results can be saved as a baseline and later runs compared to it:
+
+    python benchmarks/ingestion.py --save baseline.json
+    python benchmarks/ingestion.py --compare baseline.json
+"""
+
+from copy import deepcopy
+import json
+import logging
+from multiprocessing import Process, Queue
+from Queue import Empty
+import platform
+import resource
+from time import time
+import traceback
+
+import ukirt2caom2.ingest
+from ukirt2caom2.ingest import IngestRaw
+from ukirt2caom2.instrument import instrument_classes
+import ukirt2caom2.instrument.ukirt
+
+from documents import header_document
+from fakes import FakeOMP, FakeReleaseCalculator, FakeRepoClient, \
+    FakeTranslator
+
+# Steps of IngestRaw through which the documents are passed.
+steps = ('normalize', 'translate', 'fetch', 'build', 'serialize', 'send')
+
+# Phases of ObservationUKIRT.ingest, which are part of the build step.
+phases = {
+    'ingest_type_intent': 'type_intent',
+    'ingest_target': 'target',
+    'ingest_environment': 'environment',
+    'ingest_instrument': 'instrument',
+    'ingest_plane': 'plane_wcs',
+}
+
+class BenchmarkIngestRaw(IngestRaw):
+    """IngestRaw using fakes instead of external services.
+
+    The object is set up by IngestRaw's own constructor, with the
+    classes it uses to connect to the services temporarily replaced
+    by fakes, so that it has all of the attributes of a real one."""
+
+    fakes = {
+        'OMP': lambda password=None: FakeOMP(),
+        'Proposals': lambda cache=None: None,
+        'HeaderDB': lambda: None,
+        'CAOM2RepoClient': FakeRepoClient,
+    }
+
+    def __init__(self):
+        originals = dict((x, getattr(ukirt2caom2.ingest, x))
+                         for x in self.fakes)
+
+        try:
+            for (name, fake) in self.fakes.items():
+                setattr(ukirt2caom2.ingest, name, fake)
+
+            IngestRaw.__init__(self)
+
+        finally:
+            for (name, original) in originals.items():
+                setattr(ukirt2caom2.ingest, name, original)
+
+        self.translator = FakeTranslator()
+
+class Timer():
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, name, elapsed):
+        self.totals[name] = self.totals.get(name, 0.0) + elapsed
+
+    def timed(self, name, function):
+        def timed_function(*args, **kwargs):
+            start = time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(name, time() - start)
+
+        return timed_function
+
+def timed_class(cls, timer):
+    """Create a sub-class of an instrument class which records the
+    time spent in each phase of ingestion."""
+
+    methods = {}
+
+    for (method, phase) in phases.items():
+        methods[method] = timer.timed(phase, getattr(cls, method))
+
+    return type(cls.__name__, (cls,), methods)
+
+def run_instrument(instrument, number):
+    """Ingest ``number`` synthetic observations for an instrument.
+
+    Returns a dictionary of results."""
+
+    timer = Timer()
+    ukirt2caom2.instrument.ukirt.release_calculator = FakeReleaseCalculator()
+    instrument_classes[instrument] = timed_class(
+        instrument_classes[instrument], timer)
+
+    raw = BenchmarkIngestRaw()
+    docs = [header_document(instrument, obs) for obs in range(1, number + 1)]
+    errors = []
+
+    # Ingest a few documents first so that one-off setup is not timed.
+    for doc in deepcopy(docs[:5]):
+        for item in raw.prepare_documents([doc], None, None):
+            raw.translate_items(instrument, None, [item])
+            raw.fetch_observation(item, instrument, None, None, False, None)
+            raw.build_observation(item, instrument, None)
+
+    timer.totals = {}
+    raw.client = FakeRepoClient()
+    docs = deepcopy(docs)
+
+    start = time()
+
+    for doc in docs:
+        step_start = time()
+        items = raw.prepare_documents([doc], None, None)
+        timer.add('normalize', time() - step_start)
+
+        step_start = time()
+        raw.translate_items(instrument, None, items)
+        timer.add('translate', time() - step_start)
+
+        for item in items:
+            step_start = time()
+            raw.fetch_observation(item, instrument, None, None, True, None)
+            timer.add('fetch', time() - step_start)
+
+            step_start = time()
+            raw.build_observation(item, instrument, None)
+            timer.add('build', time() - step_start)
+
+            step_start = time()
+            raw.serialize_observation(item, False, True)
+            timer.add('serialize', time() - step_start)
+
+            step_start = time()
+            raw.send_observation(item, None, True, False, None,
+                                 errors.append)
+            timer.add('send', time() - step_start)
+
+    elapsed = time() - start
+
+    return {
+        'observations': number,
+        'errors': len([x for x in errors if x is not None]),
+        'obs_per_sec': number / elapsed,
+        'seconds': dict((x, timer.totals.get(x, 0.0))
+                        for x in steps + tuple(phases.values())),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def _run_process(queue, instrument, number, log_level):
+    # Always send something back so that the parent does not wait
+    # for ever if the benchmark fails.
+    try:
+        logging.basicConfig(level=log_level)
+        queue.put((run_instrument(instrument, number), None))
+
+    except BaseException:
+        queue.put((None, traceback.format_exc()))
+
+def _wait_result(queue, process):
+    """Get the result of a benchmark process, checking that the
+    process is still running while waiting."""
+
+    while True:
+        try:
+            return queue.get(timeout=1)
+
+        except Empty:
+            if not process.is_alive():
+                # The process may have put its result just before exiting.
+                try:
+                    return queue.get(timeout=1)
+
+                except Empty:
+                    return (None, 'Process exited with code {}'.format(
+                                  process.exitcode))
+
+def run_all(instruments, number, log_level=logging.ERROR):
+    results = {}
+    failures = {}
+
+    for instrument in instruments:
+        queue = Queue()
+        process = Process(target=_run_process,
+                          args=(queue, instrument, number, log_level))
+        process.start()
+        (result, error) = _wait_result(queue, process)
+        process.join()
+
+        if error is None:
+            results[instrument] = result
+        else:
+            failures[instrument] = error
+
+    return (results, failures)
+
+def compare(results, baseline, tolerance):
+    """Compare results with a baseline.
+
+    Prints the change in observations per second and in the time of
+    each step and phase.  Returns the number of metrics which are slower
+    by more than the ``tolerance`` (a fraction)."""
+
+    num_slower = 0
+
+    for (instrument, result) in sorted(results.items()):
+        base = baseline['results'].get(instrument)
+
+        if base is None:
+            print('{}: not in baseline'.format(instrument))
+            continue
+
+        change = result['obs_per_sec'] / base['obs_per_sec'] - 1.0
+        flag = ''
+        if change < -tolerance:
+            flag = ' SLOWER'
+            num_slower += 1
+
+        print('{:9} obs/s {:10.1f} -> {:10.1f} ({:+.1%}){}'.format(
+              instrument, base['obs_per_sec'], result['obs_per_sec'],
+              change, flag))
+
+        for (name, seconds) in sorted(result['seconds'].items()):
+            base_seconds = base['seconds'].get(name)
+
+            if not base_seconds:
+                continue
+
+            # Compare time per observation in case the number differs.
+            change = ((seconds / result['observations']) /
+                      (base_seconds / base['observations'])) - 1.0
+            flag = ''
+            if change > tolerance:
+                flag = ' SLOWER'
+                num_slower += 1
+
+            print('    {:14} {:+.1%}{}'.format(name, change, flag))
+
+        print('    {:14} {} -> {} kB'.format(
+              'peak memory', base['peak_rss_kb'], result['peak_rss_kb']))
+
+    return num_slower
+
+def print_results(results):
+    for (instrument, result) in sorted(results.items()):
+        print('{:9} {:10.1f} obs/s  errors: {}  peak memory: {} kB'.format(
+              instrument, result['obs_per_sec'], result['errors'],
+              result['peak_rss_kb']))
+
+        for name in steps + tuple(sorted(phases.values())):
+            seconds = result['seconds'][name]
+            print('    {:14} {:10.1f} us/obs'.format(
+                  name, 1.0e6 * seconds / result['observations']))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    import sys
+
+    parser = ArgumentParser()
+    parser.add_argument('--number', type=int, default=500,
+                        help='number of observations per instrument')
+    parser.add_argument('--instrument', '-i', action='append',
+                        choices=sorted(instrument_classes.keys()),
+                        help='instrument to benchmark (default all)')
+    parser.add_argument('--save', type=str, default=None,
+                        help='file in which to save the results')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='baseline file with which to compare')
+    parser.add_argument('--tolerance', type=float, default=10.0,
+                        help='allowed slow-down (percent)')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    (results, failures) = run_all(
+        args.instrument or sorted(instrument_classes.keys()), args.number,
+        logging.DEBUG if args.verbose else logging.ERROR)
+
+    print_results(results)
+
+    for (instrument, error) in sorted(failures.items()):
+        print('{}: benchmark failed\n{}'.format(instrument, error))
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'host': platform.node(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        if compare(results, baseline, args.tolerance / 100.0):
+            sys.exit(1)
+
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""Benchmark of header normalization.
+
+Compares the separate document_to_ascii and fixup_headers passes
+with the fused normalize_document function on synthetic UFTI and
+CGS4 documents, reporting cards per second.  Documents with unicode
+values (as from pymongo), byte string values and a mixture of both
+are tested.
+
+    python benchmarks/normalize.py --number 2000
+"""
+
+from copy import deepcopy
+from time import time
+
+from ukirt2caom2.fixup_headers import fixup_headers, normalize_document
+from ukirt2caom2.util import document_to_ascii
+
+from documents import count_cards, header_document, string_types
+
+def two_pass(doc):
+    document_to_ascii(doc)
+    fixup_headers(doc)
+
+def value_types(docs):
+    """Get the values of a list of documents, with their types,
+    for comparison."""
+
+    return [
+        [sorted((k, type(v), v) for (k, v) in header.items())
+         for header in doc['headers']] +
+        [sorted((k, type(v), v) for (k, v) in doc.items() if k != 'headers')]
+        for doc in docs]
+
+def measure(function, docs, repeat):
+    """Apply a function to fresh copies of the documents ``repeat``
+    times, returning the best time."""
+
+    best = None
+
+    for i in range(repeat):
+        copies = deepcopy(docs)
+
+        start = time()
+        for doc in copies:
+            function(doc)
+        elapsed = time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--number', type=int, default=1000,
+                        help='number of documents per instrument')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--strings', choices=string_types, action='append',
+                        help='type of string values (default all)')
+    args = parser.parse_args()
+
+    for instrument in ('ufti', 'cgs4'):
+        for string_type in args.strings or string_types:
+            docs = [header_document(instrument, obs, string_type=string_type)
+                    for obs in range(1, args.number + 1)]
+            num_cards = sum(count_cards(doc) for doc in docs)
+
+            # Check that both methods give the same result, including
+            # the types of the values.
+            (expected, fused) = deepcopy(docs[:50]), deepcopy(docs[:50])
+            for doc in expected:
+                two_pass(doc)
+            for doc in fused:
+                normalize_document(doc)
+            if value_types(expected) != value_types(fused):
+                raise Exception('Normalized documents differ for {} ({})'
+                                .format(instrument, string_type))
+
+            before = measure(two_pass, docs, args.repeat)
+            after = measure(normalize_document, docs, args.repeat)
+
+            print('{:5} {:7} {:8d} cards  two-pass: {:10.0f} cards/s  '
+                  'fused: {:10.0f} cards/s  speedup: {:.2f}'.format(
+                      instrument, string_type, num_cards,
+                      num_cards / before, num_cards / after, before / after))
@@ -0,0 +1,91 @@
+from hashlib import sha1
+from importlib import import_module
+import json
+from types import CodeType
+
+from ukirt2caom2.instrument import instrument_classes
+
+# Modules, other than those defining the instrument classes, whose
+# code affects the CAOM-2 records which we produce.  This includes
+# the release date policy, and the ingestion module itself, which
+# sets up the proposal and telescope.
+common_modules = (
+    'ukirt2caom2.coord',
+    'ukirt2caom2.fixup_headers',
+    'ukirt2caom2.geolocation',
+    'ukirt2caom2.ingest',
+    'ukirt2caom2.instrument.rutstartend',
+    'ukirt2caom2.keywordvalue',
+    'ukirt2caom2.native_translate',
+    'ukirt2caom2.release_date',
+    'ukirt2caom2.util',
+    'ukirt2caom2.valid_project_code',
+    'ukirt2caom2.wcs_util',
+)
+
+def code_version(instrument, translator_version=None):
+    """Compute a hash of the code used to ingest an instrument's data.
+
+    This covers the code of the modules defining the instrument
+    class and its base classes (and hence the filter tables) as well
+    as the common modules listed above.  The version of the header
+    translator can also be included.
+
+    The modules are compiled and their code hashed without line
+    numbers, so editing comments or blank lines does not change the
+    version, but any other change (including to docstrings) does,
+    and will cause every observation to be ingested again in
+    changed-only mode."""
+
+    modules = set(common_modules)
+
+    for cls in instrument_classes[instrument].__mro__:
+        if cls is not object:
+            modules.add(cls.__module__)
+
+    hash = sha1()
+
+    for module in sorted(modules):
+        filename = import_module(module).__file__
+
+        if filename.endswith(('.pyc', '.pyo')):
+            filename = filename[:-1]
+
+        with open(filename, 'rb') as f:
+            _hash_code(hash, compile(f.read(), module, 'exec'))
+
+    if translator_version is not None:
+        hash.update(str(translator_version))
+
+    return hash.hexdigest()
+
+def _hash_code(hash, code):
+    """Add a code object to a hash, excluding its line numbers."""
+
+    for part in (code.co_code, code.co_names, code.co_varnames,
+                 code.co_freevars, code.co_cellvars):
+        hash.update(repr(part))
+
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            _hash_code(hash, const)
+        else:
+            hash.update(repr(const))
+
+def observation_fingerprint(doc, project_info, code_version):
+    """Compute the fingerprint of an observation.
+
+    This is a hash of the (normalized) header document, project
+    information and code version.  If any of these change then
+    the observation should be ingested again."""
+
+    hash = sha1()
+
+    hash.update(json.dumps(
+        [doc['filename'], doc['utdate'], doc['obs'], doc['headers'],
+         None if project_info is None else list(project_info)],
+        sort_keys=True, separators=(',', ':'), default=repr))
+
+    hash.update(code_version)
+
+    return hash.hexdigest()
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+from codecs import ascii_encode
+
 def fixup_headers(doc):
     """Attempt to fix mangled FITS headers.
 
@@ -36,3 +38,75 @@ def fixup_headers(doc):
                     except ValueError:
                         hdr[card] = val
 
+
+# Normalized forms of unicode values already seen by normalize_document.
+# Header documents repeat many values (instrument names, modes, filters
+# etc.) so most lookups are hits.  The cache is cleared when it reaches
+# the maximum size.
+_normalized_cache = {}
+_normalized_cache_size = 100000
+
+def normalize_document(doc):
+    """Convert unicode in a document to ASCII and fix mangled headers.
+
+    This is equivalent to calling ``document_to_ascii`` followed by
+    ``fixup_headers``, but examines each card only once and only
+    alters those values which need to be changed.  The normalized
+    forms of unicode values are cached.
+
+    Alters the supplied document in place and
+    doesn't return anything."""
+
+    cache = _normalized_cache
+
+    if len(cache) > _normalized_cache_size:
+        cache.clear()
+
+    for hdr in doc['headers']:
+        # Take the list of cards (with their values) once, since the
+        # header is altered as it is processed.
+        for (card, val) in hdr.items():
+            val_type = type(val)
+
+            if val_type is unicode:
+                new = cache.get(val)
+
+                if new is None:
+                    new = cache[val] = _normalize_value(
+                        ascii_encode(val)[0])
+
+                hdr[card] = new
+
+            elif val_type is str:
+                # Byte strings only need to be changed if mangled.
+                if len(val) > 23 and val.find('/', 23) != -1:
+                    hdr[card] = _normalize_value(val)
+
+    for key in doc:
+        if key != 'headers':
+            val = doc[key]
+            if type(val) is unicode:
+                doc[key] = ascii_encode(val)[0]
+
+
+def _normalize_value(val):
+    """Fix a single (ASCII) string value, removing any comment
+    and converting it to a number if possible."""
+
+    pos = val.find('/', 23) if len(val) > 23 else -1
+
+    if pos == -1:
+        return val
+
+    val = val[:pos].rstrip()
+
+    if val.startswith('='):
+        val = val[1:]
+
+    try:
+        return int(val)
+    except ValueError:
+        try:
+            return float(val)
+        except ValueError:
+            return val
@@ -1,9 +1,18 @@
+from codecs import ascii_encode
+from collections import namedtuple
+from functools import partial
 from io import BytesIO
+from itertools import groupby
+import logging
 from logging import getLogger
+from multiprocessing import Manager, Pool, Queue as ProcessQueue
+from multiprocessing.util import Finalize
 from os import makedirs
 from os.path import exists, join, splitext
 import re
 from sys import stdout
+from threading import Lock, RLock, Thread
+from time import time
 
 from caom2 import Proposal, SimpleObservation, Telescope
 from caom2.xml.caom2_observation_reader import ObservationReader
@@ -13,200 +22,990 @@ from caom2repoClient.caom2repoClient \
     import CAOM2RepoClient, CAOM2RepoError, CAOM2RepoNotFound
 
 from ukirt2caom2 import IngestionError
-from ukirt2caom2.fixup_headers import fixup_headers
+from ukirt2caom2.fingerprint import code_version, observation_fingerprint
+from ukirt2caom2.fixup_headers import normalize_document
 from ukirt2caom2.geolocation import ukirt_geolocation
 from ukirt2caom2.instrument import instrument_classes
+from ukirt2caom2.metrics import IngestionMetrics
 from ukirt2caom2.mongo import HeaderDB
+from ukirt2caom2.native_translate import NativeTranslator
 from ukirt2caom2.omp import OMP
+from ukirt2caom2.pipeline import Pipeline, Stage
+from ukirt2caom2.project_cache import ProjectCache
 from ukirt2caom2.proposals import Proposals
+from ukirt2caom2.repo_presence import RepoPresence
+from ukirt2caom2.repo_sink import default_repo_url, \
+    RepoConflict, RepoConnection, RepoSink
+from ukirt2caom2.state import IngestionState
+from ukirt2caom2.timing import NullTimer, StageTimer
 from ukirt2caom2.translate import TranslationError, Translator
-from ukirt2caom2.util import document_to_ascii
+from ukirt2caom2.translation_cache import CachingTranslator
+from ukirt2caom2.translator_pool import TranslatorPool
 from ukirt2caom2.valid_project_code import valid_project_code
 
 from SECRET import staff_password
 
 logger = getLogger(__name__)
 
+# Instruments for which we do not attempt to translate the headers.
+untranslated_instruments = ('cgs3',)
+
+# Stages of the ingestion pipeline which can have multiple workers.
+pipeline_stages = ('normalize', 'translate', 'build', 'serialize')
+
+# Brief description of an observation, as given by
+# IngestRaw.observation_summaries.
+ObservationSummary = namedtuple('ObservationSummary',
+                                ['date', 'obsnum', 'uri', 'recipe', 'intent'])
+
 valid_date = re.compile('^\d\d\d\d-\d\d-\d\dT\d\d:\d\d:\d\dZ?$')
 
 class IngestRaw:
-    def __init__(self):
+    def __init__(self, translation_cache=None, project_cache=None,
+                 project_cache_ttl=None, offline=False, batch_size=None,
+                 repo_url=None, repo_cert=None, repo_workers=0,
+                 repo_gzip=False, presence_list=False, presence_manifest=None,
+                 pipeline_workers=None, pipeline_queue_size=16,
+                 pipeline_chunk=100, timing=None, timing_slowest=10,
+                 metrics=None, native_translation=(), translator_workers=None,
+                 translator_timeout=300):
+        # Record options so that parallel workers can be set up the same way.
+        self.options = {
+            'translation_cache': translation_cache,
+            'project_cache': project_cache,
+            'project_cache_ttl': project_cache_ttl,
+            'offline': offline,
+            'batch_size': batch_size,
+            'repo_url': repo_url,
+            'repo_cert': repo_cert,
+            'repo_workers': repo_workers,
+            'repo_gzip': repo_gzip,
+            'presence_list': presence_list,
+            'presence_manifest': presence_manifest,
+            'pipeline_workers': pipeline_workers,
+            'pipeline_queue_size': pipeline_queue_size,
+            'pipeline_chunk': pipeline_chunk,
+            'timing': timing,
+            'timing_slowest': timing_slowest,
+            'native_translation': native_translation,
+            'translator_workers': translator_workers,
+            'translator_timeout': translator_timeout,
+        }
+
         self.geo = ukirt_geolocation()
-        self.omp = OMP(password=staff_password)
-        self.prop = Proposals()
+
+        if project_cache is None:
+            if offline:
+                raise IngestionError('Offline mode requires a project cache')
+            self.project_db = None
+        else:
+            cache_options = {'snapshot': offline}
+            if project_cache_ttl is not None:
+                cache_options['ttl'] = project_cache_ttl
+            self.project_db = ProjectCache(project_cache, **cache_options)
+
+        self.omp = None if offline else OMP(password=staff_password)
+        self.prop = Proposals(cache=self.project_db)
         self.db = HeaderDB()
         self.reader = ObservationReader(True)
         self.writer = ObservationWriter(True)
-        self.translator = Translator()
-        self.client = CAOM2RepoClient()
+
+        # The HdrTrans translator is started when first needed, so that
+        # Perl is not required for instruments using the Python
+        # translation.
+        self.translator = None
+        self.translator_lock = Lock()
+        self.translation_cache = translation_cache
+        self.native_translators = dict(
+            (x, NativeTranslator(x)) for x in native_translation)
+
+        # Number of Perl interpreters to use for translation, if they
+        # are to be pooled.
+        self.translator_workers = translator_workers
+        self.translator_timeout = translator_timeout
+
+        self.repo_url = repo_url
+        self.repo_cert = repo_cert
+        self.repo_gzip = repo_gzip
+        self.repo_workers = repo_workers
+
+        self.client = self.new_client()
+        self.sink = RepoSink(self.new_client, repo_workers) \
+            if repo_workers else None
+
         self.project_cache = {}
+        self.project_lock = RLock()
+        self.code_versions = {}
+        self.batch_size = batch_size
+
+        self.presence_list = presence_list
+        self.presence_manifest = presence_manifest
+        self.presence = None
+
+        # Worker counts for the pipeline stages, or None to ingest
+        # each observation in turn.
+        self.pipeline_workers = pipeline_workers
+        self.pipeline_queue_size = pipeline_queue_size
+        self.pipeline_chunk = pipeline_chunk
+
+        # File in which to save the timing summary, if timing is enabled.
+        self.timing = timing
+        self.timing_slowest = timing_slowest
+        self.timer = NullTimer() if timing is None else StageTimer()
+
+        # IngestionMetrics object to update, if any.  This is not
+        # included in the options as parallel workers pass their
+        # updates back to this process's object.
+        self.metrics = metrics
 
     def __call__(self, instrument, date=None, obs_num=None,
                  use_repo=False, out_dir=None, dump=False,
-                 return_observations=False, control_file=None):
+                 return_observations=False, control_file=None, jobs=1,
+                 changed_only=False):
+        if changed_only and control_file is None:
+            raise IngestionError('Changed-only mode requires a control file')
+
+        if jobs > 1:
+            if return_observations or obs_num is not None:
+                raise IngestionError(
+                    'Parallel ingestion only supports whole nights')
+
+            return self.ingest_parallel(instrument, date, use_repo, out_dir,
+                                        dump, control_file, jobs,
+                                        changed_only)
+
+        all_obs = {} if return_observations else None
+
+        if self.metrics is not None:
+            self.metrics.set_total(self.db.count(instrument, date, obs_num))
+
+        state = None if control_file is None else IngestionState(control_file)
+
+        try:
+            (num_success, num_errors) = self.ingest_documents(
+                instrument, date, obs_num, use_repo, out_dir, dump,
+                state, None if state is None else state.record, all_obs,
+                changed_only)
+
+        finally:
+            if state is not None:
+                state.close()
+
+        logger.info('Ingestion run finished, number ingested: ' + str(num_success))
+
+        if self.timing is not None:
+            self.timer.report(self.timing, self.timing_slowest)
+
+        if return_observations:
+            return all_obs
+        else:
+            return num_errors
+
+    def close(self):
+        """Finish sending observations, close connections and stop
+        the header translator(s)."""
+
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+        if hasattr(self.client, 'close'):
+            self.client.close()
+
+        with self.translator_lock:
+            if self.translator is not None:
+                self.translator.close()
+                self.translator = None
+
+    def observation_summaries(self, instrument, date=None, obs_num=None):
+        """Generate a summary of each of the selected observations.
+
+        The observations are built but not stored or sent to the
+        repository.  This is a generator yielding an ObservationSummary
+        for each observation which could be built, in order of date
+        and observation number.  Documents are read and translated in
+        chunks, and the built observations are not retained, so the
+        memory used does not depend on the number of observations.
+
+        If several documents give the same date and observation number,
+        only the last is summarized (as it would have replaced the
+        others in the dictionary given by ``return_observations``).
+        Such documents are adjacent, as they are sorted by date and
+        observation number, so only one summary needs to be held back."""
+
+        self.prefetch_projects(instrument, date, obs_num)
+
+        cursor = self.db.find(instrument, date, obs_num,
+                              fields=self.header_fields(instrument),
+                              batch_size=self.batch_size)
+
+        pending = None
+
+        for docs in _document_chunks(cursor, self.pipeline_chunk):
+            items = self.prepare_documents(docs, None, None)
+
+            self.translate_items(instrument, date, items)
+
+            for item in items:
+                self.fetch_observation(item, instrument, date, obs_num,
+                                       False, None)
+                self.build_observation(item, instrument, date)
+
+                if item.message is not None:
+                    logger.warning('Could not build observation {}: {}'.format(
+                                   item.filename, item.message))
+                    continue
+
+                summary = ObservationSummary(
+                    item.doc['utdate'] if date is None else date,
+                    item.caom2_obs.sequence_number,
+                    item.uri,
+                    item.doc['headers'][0].get('RECIPE'),
+                    item.caom2_obs.intent)
+
+                # Release the observation before the rest of the chunk
+                # is processed.
+                item.observation = item.caom2_obs = None
+
+                if pending is not None and \
+                        (pending.date, pending.obsnum) != \
+                        (summary.date, summary.obsnum):
+                    yield pending
+
+                pending = summary
+
+        if pending is not None:
+            yield pending
+
+    def ingest_parallel(self, instrument, date, use_repo, out_dir, dump,
+                        control_file, jobs, changed_only=False):
+        """Ingest the selected observations using a pool of processes.
+
+        The observations are divided by UT date, with each night being
+        handled by one of the worker processes.  Each worker has its own
+        IngestRaw object, and therefore its own connections to the
+        various services.  The ingestion state, counts and log messages
+        are collected by this (the parent) process.  If there is an
+        IngestionMetrics object, the workers also count the outcome
+        of each document (including skipped documents) and project
+        cache lookup, and send the counts to this process in batches."""
+
+        dates = self.db.dates(instrument, date)
+
+        if self.metrics is not None:
+            self.metrics.set_total(self.db.count(instrument, date))
+
+        logger.info('Ingesting {} nights using {} processes'.format(
+                    len(dates), jobs))
+
         num_errors = 0
         num_success = 0
-        all_obs = {}
 
-        if control_file is None:
-            control = None
+        manager = Manager()
+        log_queue = manager.Queue()
+        log_thread = Thread(target=_log_listener, args=(log_queue,))
+        log_thread.daemon = True
+        log_thread.start()
+
+        if self.metrics is not None:
+            metrics_queue = ProcessQueue()
+            metrics_thread = Thread(target=_metrics_listener,
+                                    args=(metrics_queue, self.metrics))
+            metrics_thread.daemon = True
+            metrics_thread.start()
         else:
-            control = read_control_file(control_file)
-            control_file = open(control_file, 'a')
+            metrics_queue = None
+
+        # Open the state before starting the workers, so that the
+        # database has been created by the time they open it read-only.
+        state = None if control_file is None else IngestionState(control_file)
+
+        pool = Pool(jobs, _worker_init,
+                    (log_queue, getLogger().getEffectiveLevel(),
+                     control_file, self.options, metrics_queue))
+
+        try:
+            tasks = [(instrument, x, use_repo, out_dir, dump, changed_only)
+                     for x in dates]
+
+            for (night, night_results, night_success, night_errors,
+                    night_timing) in \
+                    pool.imap_unordered(_worker_ingest_night, tasks):
+                logger.info('Finished night {}, number ingested: {}'.format(
+                            night, night_success))
+
+                num_success += night_success
+                num_errors += night_errors
+                self.timer.merge(night_timing)
+
+                if state is not None:
+                    for (filename, message, fingerprint) in night_results:
+                        state.record(filename, message, fingerprint)
+                    state.commit()
+
+            pool.close()
+
+        except:
+            pool.terminate()
+            raise
+
+        finally:
+            pool.join()
+
+            if state is not None:
+                state.close()
+
+            log_queue.put(None)
+            log_thread.join()
+
+            if metrics_queue is not None:
+                metrics_queue.put(None)
+                metrics_thread.join()
+
+            manager.shutdown()
+
+        logger.info('Ingestion run finished, number ingested: ' + str(num_success))
+
+        if self.timing is not None:
+            self.timer.report(self.timing, self.timing_slowest)
+
+        return num_errors
+
+    def ingest_documents(self, instrument, date, obs_num, use_repo, out_dir,
+                         dump, control, record, all_obs, changed_only=False):
+        """Ingest the observations found by HeaderDB.find.
+
+        Files in the ``control`` collection (e.g. an IngestionState)
+        are skipped.  In ``changed_only`` mode, ``control`` must be an
+        IngestionState and instead files are skipped if their fingerprint
+        has not changed.  The ``record`` function is called with the name
+        of each file which is ingested, the error message (or None) and
+        its fingerprint.  If ``all_obs`` is not None, the observations are
+        stored in it.
+
+        If pipeline workers were configured, the stages of ingestion
+        are run concurrently, otherwise each observation is processed
+        in turn.
+
+        Returns a (number successful, number of errors) tuple."""
+
+        outcome = _RunOutcome(record, self.metrics)
+
+        self.prefetch_projects(instrument, date, obs_num)
+
+        if use_repo and (self.presence_list or
+                         self.presence_manifest is not None):
+            self.prefetch_presence(instrument, date, obs_num)
+
+        if record is not None or changed_only:
+            version = self.code_version(instrument)
+        else:
+            version = None
+
+        try:
+            cursor = self.db.find(instrument, date, obs_num,
+                                  fields=self.header_fields(instrument),
+                                  batch_size=self.batch_size)
+
+            cursor = self.timer.iterate(cursor, 'mongo',
+                                        lambda x: x['filename'])
+
+            if self.pipeline_workers is None:
+                for (night, docs) in groupby(cursor, lambda x: x['utdate']):
+                    items = self.prepare_documents(docs, control, version,
+                                                   changed_only)
+
+                    self.translate_items(instrument, date, items)
+
+                    for item in items:
+                        logger.info('Ingesting observation ' + item.filename)
+
+                        self.fetch_observation(item, instrument, date, obs_num,
+                                               use_repo, out_dir)
+                        self.build_observation(item, instrument, date)
+                        self.serialize_observation(item, dump, use_repo)
+                        self.send_observation(
+                            item, date, use_repo, dump, all_obs,
+                            partial(outcome, item.filename, item.fingerprint))
+
+            else:
+                self.ingest_pipeline(instrument, date, obs_num, use_repo,
+                                     out_dir, dump, control, version,
+                                     changed_only, all_obs, outcome, cursor)
+
+        finally:
+            # Ensure the outcomes of observations already sent are
+            # recorded even if the run is aborted.
+            if self.sink is not None:
+                self.sink.flush()
+
+            if isinstance(self.translator, CachingTranslator):
+                self.translator.flush()
+
+        return (outcome.num_success, outcome.num_errors)
+
+    def ingest_pipeline(self, instrument, date, obs_num, use_repo, out_dir,
+                        dump, control, version, changed_only, all_obs, outcome,
+                        cursor):
+        """Ingest documents from the given cursor using a Pipeline.
+
+        The documents are read (ahead) from the cursor in chunks from a
+        single night, and then pass through the normalize, translate,
+        build and serialize stages.  The observations are sent from
+        this thread, in their original order."""
+
+        workers = self.pipeline_workers
+
+        if workers.get('translate', 1) > 1 and \
+                instrument not in self.native_translators and \
+                self.translator_workers is None:
+            raise IngestionError(
+                'The header translator can only be used by one worker '
+                'unless a translator pool is used')
+
+        def normalize(docs):
+            items = self.prepare_documents(docs, control, version,
+                                           changed_only)
+            return [items] if items else []
+
+        def translate(items):
+            return self.translate_items(instrument, date, items)
+
+        def build(item, resources):
+            self.fetch_observation(item, instrument, date, obs_num, use_repo,
+                                   out_dir, resources.client, resources.reader)
+            self.build_observation(item, instrument, date)
+            return [item]
+
+        def serialize(item, writer):
+            self.serialize_observation(item, dump, use_repo, writer)
+            return [item]
+
+        stages = [
+            Stage('normalize', normalize, workers.get('normalize', 1)),
+            Stage('translate', translate, workers.get('translate', 1)),
+            Stage('build', build, workers.get('build', 1),
+                  lambda: _BuildResources(self.new_client())),
+            Stage('serialize', serialize, workers.get('serialize', 1),
+                  lambda: ObservationWriter(True)),
+        ]
+
+        pipeline = Pipeline(_document_chunks(cursor, self.pipeline_chunk),
+                            stages, self.pipeline_queue_size)
+
+        try:
+            for item in pipeline:
+                logger.info('Ingesting observation ' + item.filename)
+
+                self.send_observation(
+                    item, date, use_repo, dump, all_obs,
+                    partial(outcome, item.filename, item.fingerprint))
+
+        finally:
+            pipeline.close()
+
+    def new_client(self):
+        """Create a client for the CAOM-2 repository."""
+
+        if self.repo_url is None and not self.repo_workers:
+            return CAOM2RepoClient()
+
+        return RepoConnection(self.repo_url or default_repo_url,
+                              self.repo_cert, self.repo_gzip)
+
+    def prepare_documents(self, docs, control, version, changed_only=False):
+        """Normalize documents and select those which are to be ingested.
+
+        Returns a list of _IngestionItem objects."""
+
+        items = []
+
+        for doc in docs:
+            with self.timer.time(doc['filename'], 'normalize'):
+                normalize_document(doc)
 
-        for doc in self.db.find(instrument, date, obs_num):
-            document_to_ascii(doc)
-            fixup_headers(doc)
             filename = doc['filename']
 
-            if control is not None and filename in control:
+            if changed_only:
+                fingerprint = self.fingerprint(doc, version)
+
+                if control.fingerprint(filename) == fingerprint:
+                    logger.debug('Skipping (unchanged) ' + filename)
+                    if self.metrics is not None:
+                        self.metrics.skip()
+                    continue
+
+            elif control is not None and filename in control:
                 logger.debug('Skipping (already ingested) ' + filename)
+                if self.metrics is not None:
+                    self.metrics.skip()
                 continue
 
-            logger.info('Ingesting observation ' + filename)
+            elif version is not None:
+                fingerprint = self.fingerprint(doc, version)
 
-            obs_date = doc['utdate'] if date is None else date
+            else:
+                fingerprint = None
 
-            translated = {}
-            if instrument not in ('cgs3',):
-                try:
-                    # Take a copy of the headers and insert fake values for those
-                    # headers which we don't need but which cause HdrTrans to
-                    # abort its translation.
-                    header_copy = doc['headers'][0].copy()
-                    obs_date_fake = '{}-{}-{}T00:00:00'.format(obs_date[0:4],
-                                                obs_date[4:6], obs_date[6:8])
-                    for date_field in ('DATE-OBS', 'DATE-END'):
-                        if date_field not in header_copy or not valid_date.match(header_copy[date_field]):
-                            logger.warning('For translation, replacing {} "{}" with "{}"'.format(
-                                           date_field, header_copy.get(date_field, 'NONE'), obs_date_fake))
-                            header_copy[date_field] = obs_date_fake
+            items.append(_IngestionItem(doc, fingerprint))
 
-                    translated = self.translator.translate(header_copy)
+        return items
 
-                except TranslationError as e:
-                    logger.warning('Failed to translate headers: ' + e.message)
+    def code_version(self, instrument):
+        """Get the version of the code (and header translator)
+        used to ingest the given instrument."""
 
-            id_ = splitext(filename)[0]
-            fits_format = filename.endswith('.fits')
+        if instrument not in self.code_versions:
+            self.code_versions[instrument] = code_version(
+                instrument,
+                None if instrument in untranslated_instruments
+                else self.translator_for(instrument).version())
 
-            uri = 'ad:UKIRT/' + filename
-            caom2_uri = 'caom2:UKIRT/' + id_
-            in_repo = False
-            caom2_obs = None
+        return self.code_versions[instrument]
 
-            # Attempt to fetch observation from the CAOM-2 repository.
+    def fingerprint(self, doc, version):
+        """Compute the fingerprint of a (normalized) document."""
 
-            if use_repo:
-                logger.debug('Getting from CAOM-2: ' + caom2_uri)
-                try:
-                    xml = self.client.get_xml(caom2_uri)
+        project_id = valid_project_code(doc['headers'][0].get('PROJECT', None))
+        project_info = None if project_id is None \
+            else self.project_info(project_id)
+
+        return observation_fingerprint(doc, project_info, version)
+
+    def header_fields(self, instrument):
+        """Determine which fields need to be retrieved from the database.
+
+        Returns None (meaning all fields) if the headers are to be
+        translated, since HdrTrans may read any of them."""
+
+        if instrument not in untranslated_instruments:
+            return None
+
+        fields = ['filename', 'utdate', 'obs', 'headers.PROJECT']
+
+        for card in instrument_classes[instrument].header_cards:
+            fields.append('headers.' + card)
+
+        return fields
+
+    def translate_documents(self, instrument, date, docs):
+        """Translate the primary headers of a list of documents.
+
+        All of the headers are passed to HdrTrans in a single call.
+        Returns a list of translated headers in the same order as
+        the given documents, with an empty dictionary for any which could
+        not be translated."""
+
+        if instrument in untranslated_instruments or not docs:
+            return [{} for doc in docs]
+
+        header_copies = [translation_header(doc, date) for doc in docs]
+
+        try:
+            results = self.translator_for(instrument).translate_many(
+                header_copies)
+
+        except TranslationError as e:
+            logger.warning('Failed to translate headers: ' + e.message)
+            return [{} for doc in docs]
+
+        translations = []
+
+        for (doc, result) in zip(docs, results):
+            if isinstance(result, TranslationError):
+                logger.warning('Failed to translate headers for {}: {}'.format(
+                               doc['filename'], result.message))
+                translations.append({})
+
+            else:
+                translations.append(result)
+
+        return translations
+
+    def translator_for(self, instrument):
+        """Get the translator to be used for an instrument."""
+
+        if instrument in self.native_translators:
+            return self.native_translators[instrument]
+
+        with self.translator_lock:
+            if self.translator is None:
+                if self.translator_workers is None:
+                    self.translator = Translator()
+                else:
+                    self.translator = TranslatorPool(self.translator_workers,
+                                                     self.translator_timeout)
+
+                    if self.metrics is not None:
+                        self.metrics.set_translator_pool(self.translator)
+
+                if self.translation_cache is not None:
+                    self.translator = CachingTranslator(self.translator,
+                                                        self.translation_cache)
+
+            return self.translator
+
+    def translate_items(self, instrument, date, items):
+        """Translate the headers of a list of _IngestionItem objects.
 
-                    with BytesIO(xml) as f:
-                        caom2_obs = self.reader.read(f)
+        Returns the list of items."""
 
-                    in_repo = True
+        start = time()
 
+        translations = self.translate_documents(
+            instrument, date, [x.doc for x in items])
+
+        # Divide the time for the batch between its items.
+        elapsed = (time() - start) / max(1, len(items))
+
+        for (item, translated) in zip(items, translations):
+            item.translated = translated
+            self.timer.add(item.filename, 'translate', elapsed)
+
+        return items
+
+    def fetch_observation(self, item, instrument, date, obs_num, use_repo,
+                          out_dir, client=None, reader=None):
+        """Find the previous version of an observation.
+
+        This is fetched from the CAOM-2 repository, or read from the
+        output directory, if possible.  Otherwise a new observation
+        object is constructed."""
+
+        if client is None:
+            client = self.client
+        if reader is None:
+            reader = self.reader
+
+        doc = item.doc
+        obs_date = doc['utdate'] if date is None else date
+        caom2_uri = item.caom2_uri
+        caom2_obs = None
+
+        # Attempt to fetch observation from the CAOM-2 repository, unless
+        # we already know that it isn't there.
+
+        if use_repo and self.presence is not None and \
+                caom2_uri not in self.presence:
+            logger.debug('Not present in CAOM-2: ' + caom2_uri)
+
+        elif use_repo:
+            logger.debug('Getting from CAOM-2: ' + caom2_uri)
+            try:
+                with self.timer.time(item.filename, 'repo_get'):
+                    xml = client.get_xml(caom2_uri)
+
+                with BytesIO(xml) as f:
+                    caom2_obs = reader.read(f)
+
+                item.in_repo = True
+
+            except TypeError as e:
+                logger.error('Failed to read CAOM-2 XML from repository: ' +
+                             e.message)
+                logger.debug('Attempting to delete unreadable entry.')
+                client.remove(caom2_uri)
+
+            except CAOM2RepoNotFound:
+                # Do nothing as in_repo already initialized to False.
+                pass
+
+            except CAOM2RepoError:
+                raise IngestionError('Failed to get/remove CAOM-2 document')
+
+
+        # Check the file directory exists, and if we didn't already find
+        # the observation, attempt to read the previous version from a
+        # file.
+
+        if out_dir is not None:
+            obs_dir = join(out_dir, instrument, obs_date)
+            item.obs_file = join(obs_dir, item.id_ + '.xml')
+            if not exists(obs_dir):
+                try:
+                    makedirs(obs_dir)
+                except OSError:
+                    # Another worker may have created it.
+                    if not exists(obs_dir):
+                        raise
+
+            if caom2_obs is None and exists(item.obs_file):
+                logger.debug('Reading file: ' + item.obs_file)
+                try:
+                    caom2_obs = reader.read(item.obs_file)
                 except TypeError as e:
-                    logger.error('Failed to read CAOM-2 XML from repository: ' +
+                    logger.error('Failed to read CAOM-2 XML from disk: ' +
                                  e.message)
-                    logger.debug('Attempting to delete unreadable entry.')
-                    self.client.remove(caom2_uri)
 
-                except CAOM2RepoNotFound:
-                    # Do nothing as in_repo already initialized to False.
-                    pass
+        # Otherwise construct CAOM-2 object with basic information.
+
+        if caom2_obs is None:
+            logger.debug('Constructing new CAOM-2 object')
+            caom2_obs = SimpleObservation('UKIRT', item.id_)
+
+            caom2_obs.sequence_number = doc['obs'] if obs_num is None \
+                                                   else obs_num
+
+        item.caom2_obs = caom2_obs
+
+    def build_observation(self, item, instrument, date):
+        """Ingest the data into the CAOM-2 object.
+
+        In the case of an ingestion error, the item's message is set."""
+
+        doc = item.doc
+        obs_date = doc['utdate'] if date is None else date
+
+        try:
+            item.observation = self.ingest_observation(instrument,
+                item.caom2_obs, obs_date,
+                item.uri, item.filename.endswith('.fits'), doc['headers'],
+                item.translated, item.filename)
+
+        except IngestionError as e:
+            item.message = e.message
+
+    def serialize_observation(self, item, dump, use_repo, writer=None):
+        """Write the observation to its file, if there is one, and
+        prepare its XML representation if it is going to be dumped or
+        sent to the repository."""
+
+        if item.message is not None:
+            return
+
+        if writer is None:
+            writer = self.writer
+
+        with self.timer.time(item.filename, 'write'):
+            if item.obs_file is not None:
+                logger.debug('Writing file: ' + item.obs_file)
+                with open(item.obs_file, 'w') as f:
+                    writer.write(item.observation.caom2, f)
+
+            if dump or use_repo:
+                with BytesIO() as f:
+                    writer.write(item.observation.caom2, f)
+                    item.xml = f.getvalue()
+
+    def send_observation(self, item, date, use_repo, dump, all_obs, done):
+        """Send an observation to the CAOM-2 repository.
+
+        The ``done`` function is called with None if the observation
+        was successfully ingested, or the error message in the case of an
+        ingestion error.  If the repository sink is in use, this happens
+        once the observation has been sent, but the calls are still made
+        in the order in which the observations were sent."""
+
+        message = item.message
+
+        if message is None:
+            if all_obs is not None:
+                obs_date = item.doc['utdate'] if date is None else date
+                all_obs[(obs_date, item.caom2_obs.sequence_number)] = \
+                    (item.filename, item.uri, item.observation, item.doc)
+
+            if dump:
+                stdout.write(item.xml)
+
+            # Try to send to CAOM-2 last in case we need to
+            # raise an exception.
+
+            if use_repo:
+                if self.sink is not None:
+                    # Only the time waiting to submit the observation
+                    # is recorded.
+                    with self.timer.time(item.filename, 'repo_put'):
+                        self.sink.submit(item.caom2_uri, item.xml,
+                                         item.in_repo, done)
+                    return
+
+                try:
+                    with self.timer.time(item.filename, 'repo_put'):
+                        if not item.in_repo:
+                            logger.debug('Putting to CAOM-2: ' +
+                                         item.caom2_uri)
+                            self.put_xml(item.caom2_uri, item.xml)
+                        else:
+                            logger.debug('Updating in CAOM-2: ' +
+                                         item.caom2_uri)
+                            self.client.update_xml(item.caom2_uri, item.xml)
 
                 except CAOM2RepoError:
-                    raise IngestionError('Failed to get/remove CAOM-2 document')
+                    message = 'Failed to send to CAOM-2 repository'
+
+        if self.sink is not None:
+            self.sink.complete(done, message)
+        else:
+            done(message)
 
+    def put_xml(self, caom2_uri, xml):
+        """Put a new observation into the repository.
 
-            # Check the file directory exists, and if we didn't already find
-            # the observation, attempt to read the previous version from a
-            # file.
+        If this fails because the observation already exists (e.g. the
+        presence listing was out of date) it is updated instead.  Since
+        CAOM2RepoClient does not distinguish this error, any failure is
+        treated this way when presence information is in use."""
 
-            if out_dir is not None:
-                obs_dir = join(out_dir, instrument, obs_date)
-                obs_file = join(obs_dir, id_ + '.xml')
-                if not exists(obs_dir):
-                    makedirs(obs_dir)
+        try:
+            self.client.put_xml(caom2_uri, xml)
+
+        except CAOM2RepoError as e:
+            if not (isinstance(e, RepoConflict) or self.presence is not None):
+                raise
+
+            logger.warning('Could not put to CAOM-2, updating: ' + caom2_uri)
+            self.client.update_xml(caom2_uri, xml)
 
-                if caom2_obs is None and exists(obs_file):
-                    logger.debug('Reading file: ' + obs_file)
-                    try:
-                        caom2_obs = self.reader.read(obs_file)
-                    except TypeError as e:
-                        logger.error('Failed to read CAOM-2 XML from disk: ' +
-                                     e.message)
+    def prefetch_presence(self, instrument, date, obs_num):
+        """Determine which of the selected observations are already
+        present in the CAOM-2 repository.
 
-            # Otherwise construct CAOM-2 object with basic information.
+        This reads the manifest file, if one was specified, or otherwise
+        the repository's listing of the collection.  Only the URIs of
+        observations selected for this run are retained.
 
-            if caom2_obs is None:
-                logger.debug('Constructing new CAOM-2 object')
-                caom2_obs = SimpleObservation('UKIRT', id_)
+        The listing is limited to observations modified since the
+        first night selected, since no observation can have been
+        written to the repository before it was taken."""
 
-                caom2_obs.sequence_number = doc['obs'] if obs_num is None \
-                                                       else obs_num
+        candidates = set('caom2:UKIRT/' + splitext(filename)[0]
+                         for filename in self.db.filenames(
+                             instrument, date, obs_num))
 
-            # Ingest the data into the CAOM2 object
+        self.presence = RepoPresence('UKIRT')
 
+        if self.presence_manifest is not None:
+            logger.info('Reading repository manifest ' + self.presence_manifest)
+            self.presence.load_manifest(self.presence_manifest, candidates)
+
+        else:
+            dates = [date] if date is not None else self.db.dates(instrument)
+            start = None if not dates else '{}-{}-{}T00:00:00.000'.format(
+                dates[0][0:4], dates[0][4:6], dates[0][6:8])
+
+            logger.info('Fetching repository listing since {}'.format(start))
+            connection = RepoConnection(self.repo_url or default_repo_url,
+                                        self.repo_cert)
             try:
-                observation = self.ingest_observation(instrument,
-                    caom2_obs, obs_date,
-                    uri, fits_format, doc['headers'], translated)
-
-                if return_observations:
-                        all_obs[(obs_date, caom2_obs.sequence_number)] = \
-                        (filename, uri, observation, doc)
-
-                if dump:
-                    self.writer.write(observation.caom2, stdout)
-
-                if out_dir is not None:
-                    logger.debug('Writing file: ' + obs_file)
-                    with open(obs_file, 'w') as f:
-                        self.writer.write(observation.caom2, f)
-
-                # Try to send to CAOM-2 last in case we need to
-                # raise an exception.
-
-                if use_repo:
-                    with BytesIO() as f:
-                        self.writer.write(observation.caom2, f)
-                        xml = f.getvalue()
-
-                    try:
-                        if not in_repo:
-                            logger.debug('Putting to CAOM-2: ' + caom2_uri)
-                            self.client.put_xml(caom2_uri, xml)
-                        else:
-                            logger.debug('Updating in CAOM-2: ' + caom2_uri)
-                            self.client.update_xml(caom2_uri, xml)
+                self.presence.load_listing(connection, candidates, start)
 
-                    except CAOM2RepoError:
-                        raise IngestionError('Failed to send to CAOM-2 repository')
+            except CAOM2RepoError as e:
+                logger.warning('Could not list the repository ({}), '
+                               'checking each observation instead'
+                               .format(str(e)))
+                self.presence = None
+                return
 
-            except IngestionError as e:
-                logger.error('Ingestion error: ' + e.message)
-                num_errors += 1
+            finally:
+                connection.close()
 
-            else:
-                num_success += 1
-                if control_file is not None:
-                    write_control_file(control_file, filename)
+        logger.info('Observations already present in CAOM-2: {} of {}'.format(
+                    len(self.presence), len(candidates)))
 
-        if control_file is not None:
-            control_file.close()
+    def prefetch_projects(self, instrument, date, obs_num):
+        """Fetch information for all of the projects in the selected
+        observations."""
 
-        logger.info('Ingestion run finished, number ingested: ' + str(num_success))
+        project_ids = set()
 
-        if return_observations:
-            return all_obs
+        for code in self.db.projects(instrument, date, obs_num):
+            if type(code) == unicode:
+                code = ascii_encode(code, 'replace')[0]
+            elif type(code) != str:
+                continue
+
+            project_id = valid_project_code(code)
+
+            if project_id is not None:
+                project_ids.add(project_id)
+
+        self.fetch_projects(project_ids)
+
+    def project_info(self, project_id):
+        """Get information about a project, using the project cache."""
+
+        if project_id not in self.project_cache:
+            self.fetch_projects([project_id])
+
+        elif self.metrics is not None:
+            self.metrics.project_lookup(1, 0)
+
+        return self.project_cache[project_id]
+
+    def fetch_projects(self, project_ids):
+        """Fetch information about the given projects into the project cache.
+
+        The sources are tried in order: the persistent project cache
+        (if configured), the OMP (unless offline) with queries in
+        batches, and the proposals file.  Projects which are not found
+        are recorded in the cache as None.
+
+        Projects already in memory or found in the persistent cache
+        count as project cache hits, and others as misses."""
+
+        project_ids = set(project_ids)
+
+        with self.project_lock:
+            missing = project_ids.difference(self.project_cache)
+            num_found = self._fetch_projects(missing)
+
+        if self.metrics is not None:
+            num_misses = len(missing) - num_found
+            self.metrics.project_lookup(len(project_ids) - num_misses,
+                                        num_misses)
+
+    def _fetch_projects(self, project_ids):
+        """Fetch the given projects, returning the number which were
+        found in the persistent cache."""
+
+        if not project_ids:
+            return 0
+
+        num_found = 0
+
+        if self.project_db is not None:
+            found = self.project_db.get_many(project_ids)
+            self.project_cache.update(found)
+
+            num_found = len(found)
+            project_ids.difference_update(found)
+
+            if not project_ids:
+                return num_found
+
+        if self.omp is not None:
+            logger.debug('Fetching information for {} projects from OMP'.format(
+                         len(project_ids)))
+            found = self.omp.project_info_many(project_ids)
         else:
-            return num_errors
+            found = {}
+
+        fetched = {}
+
+        for project_id in project_ids:
+            project_info = found.get(project_id)
+
+            if project_info is None:
+                logger.debug('Fetching project {} information from file'.format(project_id))
+                project_info = self.prop.project_info(project_id)
+
+            fetched[project_id] = project_info
+
+        self.project_cache.update(fetched)
+
+        # Only store information in the persistent cache if the
+        # OMP was consulted.
+        if self.project_db is not None and self.omp is not None:
+            self.project_db.put_many(fetched)
+
+        return num_found
 
     def ingest_observation(self, instrument, caom2_obs, date,
-                           uri, fits_format, headers, translated):
+                           uri, fits_format, headers, translated, key=None):
+        # The key under which to record timing information.
+        if key is None:
+            key = uri
+
         # Set telescope.
 
         caom2_obs.telescope = Telescope('UKIRT', *self.geo)
@@ -219,18 +1018,8 @@ class IngestRaw:
             project_info = None
 
         else:
-            if project_id in self.project_cache:
-                project_info = self.project_cache[project_id]
-
-            else:
-                logger.debug('Fetching project {} information from OMP'.format(project_id))
-                project_info = self.omp.project_info(project_id)
-
-                if project_info is None:
-                    logger.debug('Fetching project {} information from file'.format(project_id))
-                    project_info = self.prop.project_info(project_id)
-
-                self.project_cache[project_id] = project_info
+            with self.timer.time(key, 'project'):
+                project_info = self.project_info(project_id)
 
         # Add general information to the CAOM2 object
 
@@ -248,25 +1037,230 @@ class IngestRaw:
 
             caom2_obs.proposal = proposal
 
-        # Construct instrument-specific observation object.
+        # Construct instrument-specific observation object.  This
+        # includes determining the release date.
 
-        observation = instrument_classes[instrument](
-                caom2_obs, date,
-                uri, fits_format)
+        with self.timer.time(key, 'release'):
+            observation = instrument_classes[instrument](
+                    caom2_obs, date,
+                    uri, fits_format)
 
-        observation.ingest(headers, translated)
+        with self.timer.time(key, 'build'):
+            observation.ingest(headers, translated)
 
         return observation
 
-def read_control_file(filename):
-    ingested = set()
+def translation_header(doc, date=None):
+    """Prepare a copy of a document's primary header for HdrTrans.
+
+    Takes a copy of the headers and inserts fake values for those
+    headers which we don't need but which cause HdrTrans to
+    abort its translation."""
+
+    obs_date = doc['utdate'] if date is None else date
+
+    header_copy = doc['headers'][0].copy()
+    obs_date_fake = '{}-{}-{}T00:00:00'.format(obs_date[0:4],
+                                obs_date[4:6], obs_date[6:8])
+    for date_field in ('DATE-OBS', 'DATE-END'):
+        if date_field not in header_copy or not valid_date.match(header_copy[date_field]):
+            logger.warning('For translation of {}, replacing {} "{}" with "{}"'.format(
+                           doc['filename'], date_field,
+                           header_copy.get(date_field, 'NONE'), obs_date_fake))
+            header_copy[date_field] = obs_date_fake
+
+    return header_copy
+
+class _RunOutcome():
+    """Counts the outcomes of ingesting observations and passes them
+    on to a ``record`` function and IngestionMetrics object, if given."""
+
+    def __init__(self, record=None, metrics=None):
+        self.record = record
+        self.metrics = metrics
+        self.num_success = 0
+        self.num_errors = 0
+
+    def __call__(self, filename, fingerprint, message):
+        if message is None:
+            self.num_success += 1
+        else:
+            logger.error('Ingestion error for {}: {}'.format(filename, message))
+            self.num_errors += 1
+
+        if self.record is not None:
+            self.record(filename, message, fingerprint)
+
+        if self.metrics is not None:
+            self.metrics.observation(message)
+
+class _IngestionItem():
+    """An observation as it passes through the stages of ingestion."""
+
+    def __init__(self, doc, fingerprint):
+        self.doc = doc
+        self.fingerprint = fingerprint
+        self.filename = doc['filename']
+        self.id_ = splitext(self.filename)[0]
+        self.uri = 'ad:UKIRT/' + self.filename
+        self.caom2_uri = 'caom2:UKIRT/' + self.id_
+        self.translated = {}
+        self.in_repo = False
+        self.caom2_obs = None
+        self.obs_file = None
+        self.observation = None
+        self.xml = None
+        self.message = None
+
+class _BuildResources():
+    """Connections used by a build stage worker of the pipeline."""
+
+    def __init__(self, client):
+        self.client = client
+        self.reader = ObservationReader(True)
+
+    def close(self):
+        if hasattr(self.client, 'close'):
+            self.client.close()
+
+def _document_chunks(cursor, size):
+    """Divide the documents from a cursor into lists of up to ``size``
+    documents, each list containing documents from only one night."""
+
+    for (night, docs) in groupby(cursor, lambda x: x['utdate']):
+        chunk = []
+
+        for doc in docs:
+            chunk.append(doc)
+
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+# Per-process state for the workers used by IngestRaw.ingest_parallel.
+_worker_raw = None
+_worker_control = None
+
+class _QueueHandler(logging.Handler):
+    """Logging handler which passes records to the parent process."""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            # Format the message here as the arguments (and any
+            # exception information) may not be picklable.
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                record.exc_info = None
+            record.msg = record.getMessage()
+            record.args = None
+            self.queue.put(record)
+        except Exception:
+            self.handleError(record)
+
+def _log_listener(queue):
+    """Pass log records received from the workers to the local loggers."""
+
+    while True:
+        record = queue.get()
+        if record is None:
+            break
+
+        getLogger(record.name).handle(record)
+
+class _WorkerMetrics(IngestionMetrics):
+    """IngestionMetrics for a worker process.
+
+    The counts are accumulated in the worker and passed to the parent
+    process in batches, after every ``interval`` updates and when
+    ``flush`` is called, so that updating them does not wait for
+    the parent."""
+
+    def __init__(self, queue, interval=100):
+        IngestionMetrics.__init__(self, None)
+        self.queue = queue
+        self.interval = interval
+        self.num_updates = 0
+
+    def observation(self, message=None):
+        IngestionMetrics.observation(self, message)
+        self._updated()
+
+    def skip(self):
+        IngestionMetrics.skip(self)
+        self._updated()
+
+    def project_lookup(self, hits, misses):
+        IngestionMetrics.project_lookup(self, hits, misses)
+        self._updated()
+
+    def flush(self):
+        self.num_updates = 0
+        self.queue.put_nowait(self.take_counts())
+
+    def _updated(self):
+        self.num_updates += 1
+
+        if self.num_updates >= self.interval:
+            self.flush()
+
+def _metrics_listener(queue, metrics):
+    """Add the counts received from the workers to the metrics."""
+
+    while True:
+        counts = queue.get()
+        if counts is None:
+            break
+
+        metrics.add_counts(counts)
+
+def _worker_init(log_queue, log_level, control_file, options,
+                 metrics_queue=None):
+    global _worker_raw, _worker_control
+
+    root = getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(log_queue))
+    root.setLevel(log_level)
+
+    _worker_raw = IngestRaw(**options)
+    Finalize(_worker_raw, _worker_raw.close, exitpriority=10)
+
+    if metrics_queue is not None:
+        _worker_raw.metrics = _WorkerMetrics(metrics_queue)
+
+    if control_file is not None:
+        _worker_control = IngestionState(control_file, read_only=True)
+
+def _worker_ingest_night(args):
+    (instrument, date, use_repo, out_dir, dump, changed_only) = args
+
+    results = []
+
+    try:
+        _worker_raw.ingest_documents(
+            instrument, date, None, use_repo, out_dir, dump,
+            _worker_control, lambda *result: results.append(result), None,
+            changed_only)
+
+        failed = False
+
+    except Exception:
+        logger.exception('Ingestion of night {} failed'.format(date))
+        failed = True
 
-    if exists(filename):
-        with open(filename) as file:
-            for text in file:
-                ingested.add(text.strip())
+    if isinstance(_worker_raw.metrics, _WorkerMetrics):
+        _worker_raw.metrics.flush()
 
-    return ingested
+    num_errors = len([x for x in results if x[1] is not None])
 
-def write_control_file(file, text):
-    file.write(text + '\n')
+    return (date, results, len(results) - num_errors,
+            num_errors + (1 if failed else 0), _worker_raw.timer.take())
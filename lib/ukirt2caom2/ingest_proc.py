@@ -1,8 +1,12 @@
+from collections import OrderedDict
 from datetime import datetime
+from hashlib import sha1
 from io import BytesIO
 from pprint import pprint
 from logging import getLogger
+from multiprocessing.pool import ThreadPool
 import re
+from threading import local
 
 from caom2 import Algorithm, Artifact, CompositeObservation, Instrument, Plane, Telescope
 from caom2.caom2_enums import CalibrationLevel, ObservationIntentType, ProductType
@@ -19,15 +23,60 @@ pattern_fits = re.compile('ukirt_([a-z]+)_([0-9]+)_([0-9]+)_([_a-z0-9]+)\.fits')
 pattern_png = re.compile('ukirt_([a-z]+)_([0-9]+)_([0-9]+)_([_a-z0-9]+)_preview_([0-9]+)\.png')
 pattern_log = re.compile('ukirt_([a-z]+)_([0-9]+)_log_([a-z]+).txt')
 
+# Parts of the XML which differ each time an observation is written,
+# and so are excluded from its digest.
+pattern_volatile = re.compile(
+    ' caom2:id="[^"]*"|<caom2:lastModified>[^<]*</caom2:lastModified>')
+
+def xml_digest(xml):
+    """Compute a digest of an observation's XML representation,
+    ignoring the identifiers and timestamps assigned by the writer."""
+
+    return sha1(pattern_volatile.sub('', xml)).hexdigest()
+
 class IngestProc:
-    def __init__(self):
+    def __init__(self, workers=1, state=None,
+                 client_factory=CAOM2RepoClient):
         self.geolocation = ukirt_geolocation()
         self.release_calculator = ReleaseCalculator()
-        self.writer = ObservationWriter(True)
-        self.client = CAOM2RepoClient()
+        self.release_dates = {}
+        self.workers = workers
+
+        # IngestionState object recording the digest of the XML last
+        # sent for each observation (by CAOM-2 URI).
+        self.state = state
+
+        # Each thread needs its own writer and repository client.
+        self.local = local()
+        self.client_factory = client_factory
 
     def __call__(self, files):
-        observations = {}
+        self.ingest_groups(self.group_files(files).items())
+
+    def ingest_instances(self, instances):
+        """Ingest the outputs of a sequence of recipe instances.
+
+        Takes a list of (instance ID, files) pairs.  Where an observation
+        appears in more than one instance, only its products from the
+        last are used, as would be the case if each instance were
+        ingested in turn."""
+
+        observations = OrderedDict()
+
+        for (id_, files) in instances:
+            for (key, products) in self.group_files(files).items():
+                observations.pop(key, None)
+                observations[key] = products
+
+        self.ingest_groups(observations.items())
+
+    def group_files(self, files):
+        """Group file names into observations.
+
+        Returns a dictionary of lists of products by
+        (instrument, date, obsnum) key."""
+
+        observations = OrderedDict()
 
         for file in files:
             match = pattern_fits.match(file)
@@ -56,59 +105,132 @@ class IngestProc:
 
             logger.warning('Unrecognised file name: {}'.format(file))
 
-        for (key, products) in observations.items():
-            (instrument, date, obsnum) = key
+        return observations
+
+    def ingest_groups(self, observations):
+        """Ingest a list of ((instrument, date, obsnum), products) entries.
+
+        If there are multiple workers, the observations are built and
+        sent to the repository by a pool of threads.  The release dates
+        are determined first, in this thread, as the release calculator
+        can only be used by one thread."""
+
+        tasks = [(key, products, self.release_date(key[1]))
+                 for (key, products) in observations]
 
+        if self.workers > 1 and len(tasks) > 1:
+            pool = ThreadPool(min(self.workers, len(tasks)))
+
+            try:
+                pool.map(self._ingest_task, tasks, chunksize=1)
+
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            for task in tasks:
+                self._ingest_task(task)
+
+        if self.state is not None:
+            self.state.commit()
+
+    def release_date(self, date):
+        release = self.release_dates.get(date)
+
+        if release is None:
             dateobj = datetime.strptime(date, '%Y%m%d')
-            release = self.release_calculator.calculate(dateobj)
-
-            # Prior to usage of instrument classes, try just to
-            # upper case the instrument name except for Michelle.
-            instrument_name = 'Michelle' if instrument == 'michelle' else instrument.upper()
-
-            observation = CompositeObservation(
-                collection='UKIRT',
-                observation_id='{}_{}_{}'.format(instrument, date, obsnum),
-                algorithm=Algorithm('group'),
-                sequence_number=int(obsnum),
-                intent=ObservationIntentType.SCIENCE,
-                telescope=Telescope('UKIRT', *self.geolocation),
-                instrument=Instrument(instrument_name),
+            release = self.release_dates[date] = \
+                self.release_calculator.calculate(dateobj)
+
+        return release
+
+    def _ingest_task(self, task):
+        self.ingest_observation(*task)
+
+    def ingest_observation(self, key, products, release):
+        (instrument, date, obsnum) = key
+
+        if not hasattr(self.local, 'client'):
+            self.local.writer = ObservationWriter(True)
+            self.local.client = self.client_factory()
+
+        # Prior to usage of instrument classes, try just to
+        # upper case the instrument name except for Michelle.
+        instrument_name = 'Michelle' if instrument == 'michelle' else instrument.upper()
+
+        observation = CompositeObservation(
+            collection='UKIRT',
+            observation_id='{}_{}_{}'.format(instrument, date, obsnum),
+            algorithm=Algorithm('group'),
+            sequence_number=int(obsnum),
+            intent=ObservationIntentType.SCIENCE,
+            telescope=Telescope('UKIRT', *self.geolocation),
+            instrument=Instrument(instrument_name),
+            meta_release=release,
+        )
+
+        for product in products:
+            plane = Plane(
+                product_id=product,
                 meta_release=release,
+                data_release=release
             )
 
-            for product in products:
-                plane = Plane(
-                    product_id=product,
-                    meta_release=release,
-                    data_release=release
-                )
+            observation.planes[product] = plane
 
-                observation.planes[product] = plane
+            uri = 'ad:UKIRT/ukirt_{}_{}_{}_{}.fits'.format(instrument, date, obsnum, product)
 
-                uri = 'ad:UKIRT/ukirt_{}_{}_{}_{}.fits'.format(instrument, date, obsnum, product)
+            artifact = Artifact(uri, product_type=ProductType.SCIENCE)
 
-                artifact = Artifact(uri, product_type=ProductType.SCIENCE)
+            plane.artifacts[uri] = artifact
 
-                plane.artifacts[uri] = artifact
+            key = (instrument, date, obsnum, product)
 
-                key = (instrument, date, obsnum, product)
+        with BytesIO() as f:
+            self.local.writer.write(observation, f)
+            xml = f.getvalue()
 
-            with BytesIO() as f:
-                self.writer.write(observation, f)
-                xml = f.getvalue()
 
+        caom2_uri = 'caom2:UKIRT/{}_{}_{}'.format(instrument, date, obsnum)
 
-            caom2_uri = 'caom2:UKIRT/{}_{}_{}'.format(instrument, date, obsnum)
+        digest = xml_digest(xml)
+        previous = None if self.state is None \
+            else self.state.fingerprint(caom2_uri)
 
-            logger.info('Updating record: {}'.format(caom2_uri))
-            # TODO: update record rather than remove and put if it already exists.
-            try:
-                self.client.remove(caom2_uri)
-            except:
-                pass
+        if digest == previous:
+            logger.info('Record unchanged: {}'.format(caom2_uri))
+            return
 
-            try:
-                self.client.put_xml(caom2_uri, xml)
-            except CAOM2RepoError:
-                raise Exception('Failed to send to CAOM-2 repository')
+        # A new observation object has different entity IDs to the
+        # stored one, which the repository would not accept as an update,
+        # so records are replaced rather than updated.
+        try:
+            if self.state is not None and previous is None:
+                # Not sent before, so probably a new record.
+                try:
+                    logger.info('Putting new record: {}'.format(caom2_uri))
+                    self.local.client.put_xml(caom2_uri, xml)
+
+                except CAOM2RepoError:
+                    logger.info('Could not put record, replacing it: {}'
+                                .format(caom2_uri))
+                    self._replace(caom2_uri, xml)
+
+            else:
+                logger.info('Replacing record: {}'.format(caom2_uri))
+                self._replace(caom2_uri, xml)
+
+        except CAOM2RepoError as e:
+            raise Exception('Failed to send to CAOM-2 repository: ' + str(e))
+
+        if self.state is not None:
+            self.state.record(caom2_uri, None, digest)
+
+    def _replace(self, caom2_uri, xml):
+        try:
+            self.local.client.remove(caom2_uri)
+        except CAOM2RepoNotFound:
+            pass
+
+        self.local.client.put_xml(caom2_uri, xml)
@@ -32,6 +32,12 @@ cgs3_filters = {
 }
 
 class ObservationCGS3(ObservationUKIRT):
+    # Header cards read by this class.
+    header_cards = ObservationUKIRT.header_cards + (
+        'C3CHOPPR', 'C3FILT', 'C3GRAT', 'C3WAVE', 'MODE', 'UTEND',
+        'UTSTART',
+    )
+
     def ingest_instrument(self, headers):
         instrument = Instrument('CGS3')
 
@@ -37,6 +37,12 @@ cgs4_filters = {
 }
 
 class ObservationCGS4(ObservationUKIRT):
+    # Header cards read by this class.
+    header_cards = ObservationUKIRT.header_cards + (
+        'CVF', 'DETECTOR', 'DET_MODE', 'FILTERS', 'GORDER', 'GRATING',
+        'MODE', 'RUTEND', 'RUTSTART',
+    )
+
     def ingest_instrument(self, headers):
         instrument = Instrument('CGS4')
 
@@ -61,6 +61,12 @@ for (alias, filter) in (
     ircam_filters[alias] = ircam_filters[filter]
 
 class ObservationIRCAM(ObservationUKIRT):
+    # Header cards read by this class.
+    header_cards = ObservationUKIRT.header_cards + (
+        'DETECTOR', 'FILTER', 'MAGNIFIE', 'MODE', 'RUTEND', 'RUTSTART',
+        'SPD_GAIN',
+    )
+
     def ingest_instrument(self, headers):
         instrument = Instrument('IRCAM3')
 
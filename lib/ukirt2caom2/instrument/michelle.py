@@ -44,6 +44,12 @@ def parse_filter(value):
     return ((cut_on, cut_off, name), pol)
 
 class ObservationMichelle(ObservationUKIRT):
+    # Header cards read by this class.
+    header_cards = ObservationUKIRT.header_cards + (
+        'CALSELN', 'CAMERA', 'CTYPE1', 'DETMODE', 'DET_MODE', 'FILTER',
+        'GRATNAME', 'INSTMODE', 'SLITNAME',
+    )
+
     def ingest_instrument(self, headers):
         instrument = Instrument('Michelle')
 
@@ -77,6 +77,11 @@ def parse_filter(value):
         return (None, pol)
 
 class ObservationUFTI(ObservationUKIRT):
+    # Header cards read by this class.
+    header_cards = ObservationUKIRT.header_cards + (
+        'FILTER', 'MODE', 'SPD_GAIN', 'WPLANGLE',
+    )
+
     def ingest_instrument(self, headers):
         instrument = Instrument('UFTI')
 
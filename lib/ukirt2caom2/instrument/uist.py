@@ -53,6 +53,12 @@ for (alias, filter) in (
     uist_imaging_filters[alias] = uist_imaging_filters[filter]
 
 class ObservationUIST(ObservationUKIRT):
+    # Header cards read by this class.
+    header_cards = ObservationUKIRT.header_cards + (
+        'CAMLENS', 'DET_MODE', 'FILTER', 'GRISM', 'INSTMODE',
+        'POLARISE', 'READOUT', 'SLITNAME',
+    )
+
     def ingest_instrument(self, headers):
         instrument = Instrument('UIST')
 
@@ -31,6 +31,13 @@ patt_milliseconds = re.compile('\.\d\d\d$')
 release_calculator = ReleaseCalculator()
 
 class ObservationUKIRT(object):
+    # Header cards read by this class.  Sub-classes should extend this
+    # with the cards which they read.
+    header_cards = (
+        'AIRTEMP', 'AMEND', 'AMSTART', 'CSOTAU', 'DATE-END', 'DATE-OBS',
+        'HUMIDITY', 'OBJECT', 'OBSTYPE', 'RECIPE', 'STANDARD',
+    )
+
     def __init__(self, caom2_obs, date, uri, fits_format):
         self.caom2 = caom2_obs
         self.date = datetime.strptime(date, '%Y%m%d')
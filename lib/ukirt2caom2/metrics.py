@@ -0,0 +1,287 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import deque
+from logging import getLogger
+from os import rename
+from threading import Event, Lock, Thread
+from time import time
+
+logger = getLogger(__name__)
+
+prefix = 'ukirt2caom2_'
+
+class IngestionMetrics():
+    """Counters describing the progress of an ingestion run.
+
+    The update methods only increment counters under a lock, so they
+    can be called from the ingestion loop without delaying it.  The
+    exposition text is prepared separately by a MetricsPublisher."""
+
+    def __init__(self, instrument):
+        self.instrument = instrument
+        self.lock = Lock()
+        self.start = time()
+        self.total = None
+        self.done = 0
+        self.skipped = 0
+        self.errors = {}
+        self.project_hits = 0
+        self.project_misses = 0
+        self.translator_pool = None
+
+    def set_total(self, total):
+        """Set the number of documents selected for the run."""
+
+        self.total = total
+
+    def observation(self, message=None):
+        """Count an ingested observation, with its error message
+        if it failed."""
+
+        with self.lock:
+            if message is None:
+                self.done += 1
+
+            else:
+                error_type = error_type_of(message)
+                self.errors[error_type] = self.errors.get(error_type, 0) + 1
+
+    def skip(self):
+        """Count a document which was not ingested because it had
+        already been ingested (or was unchanged)."""
+
+        with self.lock:
+            self.skipped += 1
+
+    def project_lookup(self, hits, misses):
+        """Count project cache hits and misses."""
+
+        with self.lock:
+            self.project_hits += hits
+            self.project_misses += misses
+
+    def take_counts(self):
+        """Get the counts accumulated so far, and reset them."""
+
+        with self.lock:
+            counts = {
+                'done': self.done,
+                'skipped': self.skipped,
+                'errors': self.errors,
+                'project_hits': self.project_hits,
+                'project_misses': self.project_misses,
+            }
+
+            self.done = self.skipped = 0
+            self.project_hits = self.project_misses = 0
+            self.errors = {}
+
+        return counts
+
+    def add_counts(self, counts):
+        """Add counts taken (with ``take_counts``) from another
+        IngestionMetrics object, e.g. in a worker process."""
+
+        with self.lock:
+            self.done += counts['done']
+            self.skipped += counts['skipped']
+            self.project_hits += counts['project_hits']
+            self.project_misses += counts['project_misses']
+
+            for (error_type, count) in counts['errors'].items():
+                self.errors[error_type] = \
+                    self.errors.get(error_type, 0) + count
+
+    def set_translator_pool(self, pool):
+        """Set the TranslatorPool whose workers are to be described."""
+
+        self.translator_pool = pool
+
+    def snapshot(self):
+        pool = self.translator_pool
+
+        with self.lock:
+            snapshot = {
+                'total': self.total,
+                'done': self.done,
+                'skipped': self.skipped,
+                'errors': dict(self.errors),
+                'project_hits': self.project_hits,
+                'project_misses': self.project_misses,
+            }
+
+        if pool is not None:
+            snapshot['translator_queue_depths'] = pool.queue_depths()
+            snapshot['translator_restarts'] = pool.restart_counts()
+
+        return snapshot
+
+class MetricsPublisher():
+    """Publishes IngestionMetrics in the Prometheus exposition format.
+
+    Every ``interval`` seconds a thread prepares the metrics text,
+    which is written to ``filename`` (replacing it atomically) if given,
+    and served on ``localhost:port`` if a port is given.  The rate is
+    the average over the last ``window`` seconds."""
+
+    def __init__(self, metrics, filename=None, port=None, interval=15.0,
+                 window=300.0):
+        self.metrics = metrics
+        self.filename = filename
+        self.interval = interval
+        self.window = window
+        self.samples = deque()
+        self.text = ''
+        self.stopping = Event()
+        self.server = None
+
+        self.update()
+
+        if port is not None:
+            handler = type('MetricsHandler', (_MetricsHandler,),
+                           {'publisher': self})
+            self.server = HTTPServer(('localhost', port), handler)
+            server_thread = Thread(target=self.server.serve_forever)
+            server_thread.daemon = True
+            server_thread.start()
+
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """Stop publishing, after a final update."""
+
+        self.stopping.set()
+        self.thread.join()
+        self.update()
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def update(self):
+        """Prepare the metrics text and write the file, if configured."""
+
+        now = time()
+        snapshot = self.metrics.snapshot()
+        num_errors = sum(snapshot['errors'].values())
+        processed = snapshot['done'] + num_errors + snapshot['skipped']
+
+        self.samples.append((now, processed))
+        while len(self.samples) > 2 and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+        (start_time, start_processed) = self.samples[0]
+        rate = 0.0 if now <= start_time \
+            else (processed - start_processed) / (now - start_time)
+
+        instrument = 'instrument="{}"'.format(self.metrics.instrument)
+        lines = []
+
+        def metric(name, kind, help_, values):
+            lines.append('# HELP {}{} {}'.format(prefix, name, help_))
+            lines.append('# TYPE {}{} {}'.format(prefix, name, kind))
+            for (labels, value) in values:
+                lines.append('{}{}{{{}}} {}'.format(
+                    prefix, name, ','.join([instrument] + labels),
+                    _format(value)))
+
+        metric('observations_done_total', 'counter',
+               'Observations successfully ingested.',
+               [([], snapshot['done'])])
+        metric('observations_skipped_total', 'counter',
+               'Observations skipped as already ingested.',
+               [([], snapshot['skipped'])])
+        metric('errors_total', 'counter',
+               'Observations which failed, by type of error.',
+               [(['type="{}"'.format(_escape(error_type))], count)
+                for (error_type, count) in sorted(snapshot['errors'].items())])
+        metric('rate', 'gauge',
+               'Observations processed per second.',
+               [([], rate)])
+
+        if snapshot['total'] is not None:
+            remaining = max(0, snapshot['total'] - processed)
+            metric('remaining_documents', 'gauge',
+                   'Documents not yet processed.',
+                   [([], remaining)])
+
+            if rate > 0:
+                metric('eta_seconds', 'gauge',
+                       'Estimated time to complete the run.',
+                       [([], remaining / rate)])
+
+        lookups = snapshot['project_hits'] + snapshot['project_misses']
+        metric('project_cache_hits_total', 'counter',
+               'Project lookups answered from memory or the project cache.',
+               [([], snapshot['project_hits'])])
+        metric('project_cache_misses_total', 'counter',
+               'Project lookups which had to query the OMP or proposals file.',
+               [([], snapshot['project_misses'])])
+        if lookups:
+            metric('project_cache_hit_ratio', 'gauge',
+                   'Fraction of project lookups found in the cache.',
+                   [([], float(snapshot['project_hits']) / lookups)])
+
+        if 'translator_queue_depths' in snapshot:
+            metric('translator_queue_depth', 'gauge',
+                   'Requests outstanding for each header translator.',
+                   [(['worker="{}"'.format(i)], depth) for (i, depth) in
+                    enumerate(snapshot['translator_queue_depths'])])
+            metric('translator_restarts_total', 'counter',
+                   'Header translators restarted after failing.',
+                   [(['worker="{}"'.format(i)], count) for (i, count) in
+                    enumerate(snapshot['translator_restarts'])])
+
+        metric('uptime_seconds', 'gauge',
+               'Time since the run started.',
+               [([], now - self.metrics.start)])
+
+        self.text = '\n'.join(lines) + '\n'
+
+        if self.filename is not None:
+            try:
+                temporary = self.filename + '.tmp'
+                with open(temporary, 'w') as f:
+                    f.write(self.text)
+                rename(temporary, self.filename)
+
+            except (IOError, OSError) as e:
+                logger.warning('Failed to write metrics file: ' + str(e))
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.update()
+            except Exception:
+                logger.exception('Failed to update metrics')
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    publisher = None
+
+    def do_GET(self):
+        body = self.publisher.text
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def error_type_of(message):
+    """Classify an error message, by taking the part before any colon
+    (which is usually followed by specific details)."""
+
+    return message.partition(':')[0].strip() or 'unknown'
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def _format(value):
+    if isinstance(value, float):
+        return '{:.6g}'.format(value)
+
+    return str(value)
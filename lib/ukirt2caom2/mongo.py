@@ -1,4 +1,13 @@
-from pymongo import MongoClient
+from bson.son import SON
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import OperationFailure
+
+# Indexes required by the queries made on the header collections.
+header_indexes = (
+    [('utdate', ASCENDING), ('obs', ASCENDING)],
+    [('filename', ASCENDING)],
+    [('headers.0.PROJECT', ASCENDING)],
+)
 
 class HeaderDBError(Exception):
     pass
@@ -8,7 +17,223 @@ class HeaderDB:
         mongo = MongoClient()
         self.db = mongo.ukirt
 
-    def find(self, instrument, date, obs_num):
+        # Collections for which the indexes have been ensured.
+        self.indexed = set()
+
+    def dates(self, instrument, date=None):
+        """Get a sorted list of the UT dates for which there are headers."""
+
+        prototype = self._prototype(date, None)
+
+        return sorted(self.db[instrument].find(prototype).distinct('utdate'))
+
+    def projects(self, instrument, date=None, obs_num=None):
+        """Get a list of the distinct (raw) PROJECT headers."""
+
+        prototype = self._prototype(date, obs_num)
+
+        return self.db[instrument].find(prototype).distinct('headers.0.PROJECT')
+
+    def filenames(self, instrument, date=None, obs_num=None):
+        """Get a list of the distinct file names."""
+
+        prototype = self._prototype(date, obs_num)
+
+        return self.db[instrument].find(prototype).distinct('filename')
+
+    def count(self, instrument, date=None, obs_num=None):
+        """Count the documents which would be returned by find."""
+
+        prototype = self._prototype(date, obs_num)
+
+        return self.db[instrument].find(prototype).count()
+
+    def find(self, instrument, date, obs_num, fields=None, batch_size=None):
+        """Find header documents, sorted by UT date and observation number.
+
+        If a list of ``fields`` is given, only those fields are
+        retrieved.  (IngestRaw only gives fields for instruments whose
+        headers are not translated, currently just CGS3.)  The
+        ``batch_size`` controls the number of documents fetched from
+        the server at a time.
+
+        The indexes are ensured before the first query of each
+        collection, since without the (utdate, obs) index the server
+        would have to sort the documents in memory, and would fail
+        once they exceed its sort memory limit."""
+
+        prototype = self._prototype(date, obs_num)
+
+        if instrument not in self.indexed:
+            self.ensure_indexes(instrument)
+
+        cursor = self.db[instrument].find(prototype, fields=fields,
+                                          timeout=False)
+        cursor.sort([('utdate', ASCENDING), ('obs', ASCENDING)])
+
+        if batch_size is not None:
+            cursor.batch_size(batch_size)
+
+        # Check for results by fetching the first document(s) rather
+        # than with a separate count query.
+        first = next(cursor, None)
+
+        if first is None:
+            raise HeaderDBError('No headers found')
+
+        elif date is not None and obs_num is not None and \
+                next(cursor, None) is not None:
+            raise HeaderDBError('Multiple headers found')
+
+        yield first
+
+        for doc in cursor:
+            yield doc
+
+    def header_combinations(self, instrument, header, subheaders,
+                            missing='---'):
+        """Find the combinations of values of the given ``subheaders``
+        which occur with each value of ``header`` in the primary headers.
+
+        The grouping is done by the server with an aggregation pipeline,
+        so that only the results are transferred.  Documents without
+        the main header are ignored, and missing subheaders are given
+        the value ``missing`` (whereas null values become "None").
+        Returns a dictionary of sets of tuples, with values converted
+        to strings.
+
+        The pipeline works with MongoDB 2.6 (which introduced the
+        ``allowDiskUse`` option) and later."""
+
+        fields = ['s{}'.format(i) for i in range(len(subheaders))]
+
+        projection = {'headers.' + header: 1}
+        for subheader in subheaders:
+            projection['headers.' + subheader] = 1
+
+        pipeline = [
+            {'$match': {'headers.0.' + header: {'$exists': True}}},
+            {'$project': projection},
+
+            # Array elements can not be addressed by position in
+            # aggregation expressions before MongoDB 3.2 ($arrayElemAt),
+            # so select the first header of each document by unwinding
+            # the array.
+            {'$unwind': '$headers'},
+            {'$group': {'_id': '$_id', 'first': {'$first': '$headers'}}},
+
+            # Missing subheaders are left out of the value documents,
+            # so that they can be distinguished from null values.
+            {'$group': {
+                '_id': '$first.' + header,
+                'values': {'$addToSet': dict(
+                    (field, '$first.' + subheader)
+                    for (field, subheader) in zip(fields, subheaders))},
+            }},
+        ]
+
+        result = self.db[instrument].aggregate(pipeline, allowDiskUse=True)
+
+        # Older versions of PyMongo return the command response.
+        if isinstance(result, dict):
+            result = result['result']
+
+        combinations = {}
+
+        for entry in result:
+            # Different values may have the same string representation.
+            values = combinations.setdefault(str(entry['_id']), set())
+
+            for value in entry['values']:
+                values.add(tuple(str(value.get(x, missing)) for x in fields))
+
+        return combinations
+
+    def ensure_indexes(self, instrument):
+        """Create the indexes required by our queries if they
+        do not already exist.
+
+        Returns a list of the names of the indexes."""
+
+        collection = self.db[instrument]
+
+        names = [collection.ensure_index(index) for index in header_indexes]
+
+        self.indexed.add(instrument)
+
+        return names
+
+    def check_indexes(self, instrument):
+        """Check whether the queries which we make are covered by indexes.
+
+        Uses the query planner's explain output for each type of query
+        made during ingestion: the finds and the distinct queries
+        (dates, projects and file names).  The distinct queries can
+        only be explained by MongoDB 3.0 or later, so with older
+        servers the equivalent find is explained instead.  The
+        aggregation in header_combinations is not included as it is
+        a diagnostic which necessarily scans every document.
+        Returns a list of (description, indexed, sorted by index, plan)
+        tuples."""
+
+        collection = self.db[instrument]
+
+        sample = collection.find_one(fields=['utdate', 'obs', 'filename',
+                                             'headers.PROJECT'])
+
+        if sample is None:
+            raise HeaderDBError('No headers found')
+
+        try:
+            project = sample['headers'][0]['PROJECT']
+        except (KeyError, IndexError):
+            project = None
+
+        sort = [('utdate', ASCENDING), ('obs', ASCENDING)]
+
+        queries = (
+            ('find all, sorted',
+                collection.find({}).sort(sort)),
+            ('find by date, sorted',
+                collection.find(self._prototype(sample['utdate'], None)
+                                ).sort(sort)),
+            ('find by date and observation',
+                collection.find(self._prototype(sample['utdate'],
+                                                sample['obs'])).sort(sort)),
+            ('find by filename',
+                collection.find({'filename': sample['filename']})),
+            ('find by project',
+                collection.find({'headers.0.PROJECT': project})),
+        )
+
+        distinct_queries = (
+            ('distinct dates', 'utdate', {}),
+            ('distinct projects by date', 'headers.0.PROJECT',
+                self._prototype(sample['utdate'], None)),
+            ('distinct filenames by date', 'filename',
+                self._prototype(sample['utdate'], None)),
+        )
+
+        return [(description,) + _explain_plan(cursor.explain())
+                for (description, cursor) in queries] + \
+            [(description,) + _explain_plan(
+                self._explain_distinct(collection, key, query))
+             for (description, key, query) in distinct_queries]
+
+    def _explain_distinct(self, collection, key, query):
+        """Explain a distinct query, or the equivalent find if the
+        server does not support the explain command."""
+
+        try:
+            return self.db.command('explain', SON([
+                ('distinct', collection.name),
+                ('key', key),
+                ('query', query)]))
+
+        except OperationFailure:
+            return collection.find(query, fields=[key]).explain()
+
+    def _prototype(self, date, obs_num):
         prototype = {}
 
         if date is not None:
@@ -17,13 +242,34 @@ class HeaderDB:
         if obs_num is not None:
             prototype['obs'] = obs_num
 
-        cursor = self.db[instrument].find(prototype, timeout=False)
+        return prototype
 
-        if cursor.count() == 0:
-            raise HeaderDBError('No headers found')
+def _explain_plan(explain):
+    """Interpret the output of a query explanation.
 
-        elif date is not None and obs_num is not None and cursor.count() > 1:
-            raise HeaderDBError('Multiple headers found')
+    Handles both the old (MongoDB 2.x) and new (3.0+) formats.
+    Returns an (indexed, sorted by index, plan summary) tuple."""
 
-        for doc in cursor:
-            yield doc
+    if 'queryPlanner' in explain:
+        stages = []
+        stage = explain['queryPlanner']['winningPlan']
+
+        while stage is not None:
+            if 'indexName' in stage:
+                stages.append('{}({})'.format(stage['stage'],
+                                              stage['indexName']))
+            else:
+                stages.append(stage['stage'])
+
+            stage = stage.get('inputStage')
+
+        return (any(x in ' '.join(stages)
+                    for x in ('IXSCAN', 'DISTINCT_SCAN')),
+                'SORT' not in stages,
+                ' <- '.join(stages))
+
+    cursor = explain.get('cursor', '')
+
+    return (cursor.startswith('BtreeCursor'),
+            not explain.get('scanAndOrder', False),
+            '{} (scanned {})'.format(cursor, explain.get('nscanned')))
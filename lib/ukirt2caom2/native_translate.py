@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+"""Python translation of the FITS headers read by ukirt2caom2.
+
+The instrument classes only use a few of the generic headers produced
+by Astro::FITS::HdrTrans.  This module computes those headers directly
+for the instruments listed in ``native_instruments``, following the
+rules of the corresponding HdrTrans classes, so that the Perl
+interpreter is not needed for them.
+
+The translation can be compared with HdrTrans on a sample of
+observations from the header database with:
+
+    python -m ukirt2caom2.native_translate -i ufti --sample 500
+"""
+
+from math import atan2, degrees
+
+from ukirt2caom2.translate import TranslationError
+
+version = '1'
+
+# Generic headers provided by this module.
+translated_keys = (
+    'RA_BASE', 'DEC_BASE',
+    'X_REFERENCE_PIXEL', 'Y_REFERENCE_PIXEL',
+    'RA_SCALE', 'DEC_SCALE',
+    'X_LOWER_BOUND', 'X_UPPER_BOUND', 'Y_LOWER_BOUND', 'Y_UPPER_BOUND',
+    'RA_TELESCOPE_OFFSET', 'DEC_TELESCOPE_OFFSET',
+    'ROTATION',
+)
+
+class _Translation():
+    """Base class for the translation of an instrument's headers.
+
+    Each generic header is either copied from the FITS card given
+    in ``unit_map`` or computed by a ``to_<header>`` method."""
+
+    unit_map = {
+        'DEC_BASE': 'DECBASE',
+        'RA_TELESCOPE_OFFSET': 'TRAOFF',
+        'DEC_TELESCOPE_OFFSET': 'TDECOFF',
+    }
+
+    def translate(self, header):
+        result = {}
+
+        for key in translated_keys:
+            method = getattr(self, 'to_' + key, None)
+
+            if method is not None:
+                value = method(header)
+
+            else:
+                value = header.get(self.unit_map.get(key))
+
+            if value is not None:
+                result[key] = value
+
+        return result
+
+    def to_RA_BASE(self, header):
+        # RABASE is given in hours.
+        rabase = header.get('RABASE')
+
+        if rabase is None:
+            return None
+
+        return _number(rabase, 'RABASE') * 15.0
+
+    def to_ROTATION(self, header):
+        if 'CD1_1' in header:
+            # Average the rotations of the two axes from the CD matrix.
+            cd11 = _number(header['CD1_1'], 'CD1_1')
+            cd12 = _number(header.get('CD1_2', 0.0), 'CD1_2')
+            cd21 = _number(header.get('CD2_1', 0.0), 'CD2_1')
+            cd22 = _number(header.get('CD2_2', 0.0), 'CD2_2')
+
+            # A negative determinant indicates that the first axis
+            # increases to the East (i.e. CDELT1 is negative).
+            sign = -1.0 if (cd11 * cd22 - cd12 * cd21) < 0 else 1.0
+
+            rho_a = degrees(atan2(sign * cd21, sign * cd11))
+            rho_b = degrees(atan2(-cd12, cd22))
+
+            return 0.5 * (rho_a + rho_b)
+
+        if 'CROTA2' in header:
+            return _number(header['CROTA2'], 'CROTA2')
+
+        return 0.0
+
+class UFTITranslation(_Translation):
+    unit_map = dict(_Translation.unit_map, **{
+        'X_LOWER_BOUND': 'RDOUT_X1',
+        'X_UPPER_BOUND': 'RDOUT_X2',
+        'Y_LOWER_BOUND': 'RDOUT_Y1',
+        'Y_UPPER_BOUND': 'RDOUT_Y2',
+    })
+
+    # Default plate scale (arcsec per pixel).
+    default_scale = 0.0907
+
+    def to_X_REFERENCE_PIXEL(self, header):
+        return self._reference_pixel(header, 'CRPIX1', 'RDOUT_X1',
+                                     'RDOUT_X2', 20, 533)
+
+    def to_Y_REFERENCE_PIXEL(self, header):
+        return self._reference_pixel(header, 'CRPIX2', 'RDOUT_Y1',
+                                     'RDOUT_Y2', 25, 488)
+
+    def to_RA_SCALE(self, header):
+        if 'CDELT1' in header:
+            return _number(header['CDELT1'], 'CDELT1') * 3600.0
+
+        return -self.default_scale
+
+    def to_DEC_SCALE(self, header):
+        if 'CDELT2' in header:
+            return _number(header['CDELT2'], 'CDELT2') * 3600.0
+
+        return self.default_scale
+
+    def _reference_pixel(self, header, crpix, lower, upper, full_offset,
+                         default):
+        """Determine the reference pixel.
+
+        If there is no CRPIX card, the centre of the readout area is
+        used, which for a full array is offset from the centre to
+        avoid the joins between its quadrants."""
+
+        if crpix in header:
+            return header[crpix]
+
+        if lower in header and upper in header:
+            low = _number(header[lower], lower)
+            high = _number(header[upper], upper)
+            middle = int(round((low + high) / 2.0))
+
+            if high - low + 1 == 1024:
+                return middle + full_offset
+
+            return middle
+
+        return default
+
+class MichelleTranslation(_Translation):
+    unit_map = dict(_Translation.unit_map, **{
+        'X_LOWER_BOUND': 'DETECXS',
+        'X_UPPER_BOUND': 'DETECXE',
+        'Y_LOWER_BOUND': 'DETECYS',
+        'Y_UPPER_BOUND': 'DETECYE',
+        'X_REFERENCE_PIXEL': 'CRPIX1',
+        'Y_REFERENCE_PIXEL': 'CRPIX2',
+        # The Michelle class checks the units of these itself.
+        'RA_SCALE': 'CDELT1',
+        'DEC_SCALE': 'CDELT2',
+    })
+
+native_instruments = {
+    'ufti': UFTITranslation,
+    'michelle': MichelleTranslation,
+}
+
+class NativeTranslator():
+    """Translator using the Python translation for an instrument.
+
+    This has the same interface as the Translator class."""
+
+    def __init__(self, instrument):
+        if instrument not in native_instruments:
+            raise TranslationError(
+                'No native translation for instrument ' + instrument)
+
+        self.instrument = instrument
+        self.translation = native_instruments[instrument]()
+
+    def version(self):
+        return 'native-{}-{}'.format(self.instrument, version)
+
+    def translate(self, header):
+        try:
+            return self.translation.translate(header)
+
+        except (TypeError, ValueError) as e:
+            raise TranslationError(str(e))
+
+    def translate_many(self, headers, cards=None):
+        results = []
+
+        for header in headers:
+            try:
+                results.append(self.translate(header))
+
+            except TranslationError as e:
+                results.append(e)
+
+        return results
+
+def shadow_compare(native, reference, headers, tolerance=1.0e-6):
+    """Translate headers with both the native and reference (HdrTrans)
+    translators and compare the keys provided by this module.
+
+    Returns a list of (index, key, native value, reference value)
+    tuples for each difference, where numbers are considered equal
+    if their difference is within the given (relative) tolerance."""
+
+    differences = []
+
+    native_results = native.translate_many(headers)
+    reference_results = reference.translate_many(headers)
+
+    for (index, (ours, theirs)) in enumerate(
+            zip(native_results, reference_results)):
+        if isinstance(ours, TranslationError) or \
+                isinstance(theirs, TranslationError):
+            if type(ours) != type(theirs):
+                differences.append((index, None, str(ours), str(theirs)))
+
+            continue
+
+        for key in translated_keys:
+            ours_value = ours.get(key)
+            theirs_value = theirs.get(key)
+
+            if not _equal(ours_value, theirs_value, tolerance):
+                differences.append((index, key, ours_value, theirs_value))
+
+    return differences
+
+def _equal(a, b, tolerance):
+    if isinstance(a, (int, long, float)) and isinstance(b, (int, long, float)):
+        return abs(a - b) <= tolerance * max(1.0, abs(a), abs(b))
+
+    return a == b
+
+def _number(value, card):
+    if isinstance(value, (int, long, float)):
+        return value
+
+    try:
+        return float(value)
+
+    except ValueError:
+        raise ValueError('Non-numeric value for {}: {}'.format(card, value))
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from collections import Counter
+    from itertools import islice
+
+    from ukirt2caom2.fixup_headers import normalize_document
+    from ukirt2caom2.ingest import translation_header
+    from ukirt2caom2.mongo import HeaderDB
+    from ukirt2caom2.translate import Translator
+
+    parser = ArgumentParser()
+    parser.add_argument('--instrument', '-i', required=True,
+                        choices=sorted(native_instruments.keys()))
+    parser.add_argument('--date', '-d', default=None)
+    parser.add_argument('--sample', type=int, default=200,
+                        help='number of observations to compare')
+    parser.add_argument('--every', type=int, default=1,
+                        help='compare only every Nth observation')
+    parser.add_argument('--tolerance', type=float, default=1.0e-6)
+    args = parser.parse_args()
+
+    docs = []
+
+    for doc in islice(HeaderDB().find(args.instrument, args.date, None),
+                      0, None, args.every):
+        normalize_document(doc)
+        docs.append(doc)
+
+        if len(docs) >= args.sample:
+            break
+
+    differences = shadow_compare(
+        NativeTranslator(args.instrument), Translator(),
+        [translation_header(doc) for doc in docs], args.tolerance)
+
+    for (index, key, ours, theirs) in differences:
+        print('{} {}: native {!r} HdrTrans {!r}'.format(
+              docs[index]['filename'], key, ours, theirs))
+
+    by_key = Counter(x[1] for x in differences)
+
+    print('Compared {} observations, {} differences'.format(
+          len(docs), len(differences)))
+
+    for (key, count) in sorted(by_key.items()):
+        print('    {}: {}'.format(key, count))
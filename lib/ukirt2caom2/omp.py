@@ -37,6 +37,35 @@ class OMP():
             else:
                 return ProjectInfo(*cols)
 
+    def project_info_many(self, projectids, chunk_size=100):
+        """Looks up information about a number of projects.
+
+        The projects are queried in chunks of up to ``chunk_size``.
+        Returns a dictionary of ProjectInfo objects by (upper case)
+        project ID.  Projects which are not found are omitted."""
+
+        projectids = sorted(set(projectids))
+        result = {}
+
+        with closing(self.db.cursor()) as c:
+            for i in range(0, len(projectids), chunk_size):
+                chunk = projectids[i:i + chunk_size]
+                params = dict(('@p{}'.format(j), projectid)
+                              for (j, projectid) in enumerate(chunk))
+
+                c.execute('SELECT projectid, title, uname '
+                          'FROM ompproj '
+                              'LEFT JOIN ompuser '
+                                  'ON pi=userid '
+                          'WHERE projectid IN (' +
+                          ', '.join(sorted(params.keys())) + ')',
+                          params)
+
+                for (projectid, title, uname) in c.fetchall():
+                    result[projectid.upper()] = ProjectInfo(title, uname)
+
+        return result
+
 if __name__ == '__main__':
     omp = OMP()
     import sys
@@ -0,0 +1,60 @@
+package UKIRT2CAOM2::HdrTrans;
+
+=head1 NAME
+
+UKIRT2CAOM2::HdrTrans - Batch header translation for ukirt2caom2
+
+=head1 DESCRIPTION
+
+Wrapper around Astro::FITS::HdrTrans allowing many headers to be
+translated with a single call through Taco.
+
+=cut
+
+use strict;
+use warnings;
+
+use Exporter 'import';
+
+use Astro::FITS::HdrTrans qw/translate_from_FITS/;
+
+our @EXPORT_OK = qw/translate_many/;
+
+=head1 SUBROUTINES
+
+=over 4
+
+=item translate_many(\@headers)
+
+Translates each of the given headers (hash references).  Returns a
+reference to an array in the same order as the input, each entry
+of which is a hash reference containing either a "translated" entry
+(the generic headers) or an "error" entry (the error message).
+
+=cut
+
+sub translate_many {
+    my $headers = shift;
+    my @result;
+
+    foreach my $header (@$headers) {
+        my %translated = eval {translate_from_FITS($header)};
+
+        if ($@) {
+            push @result, {error => "$@"};
+        }
+        else {
+            push @result, {translated => \%translated};
+        }
+    }
+
+    return \@result;
+}
+
+1;
+
+__END__
+
+=back
+
+=cut
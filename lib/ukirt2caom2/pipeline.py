@@ -0,0 +1,223 @@
+from logging import getLogger
+from Queue import Queue
+import sys
+from threading import Lock, Thread
+
+logger = getLogger(__name__)
+
+# Marker placed on a queue after the last item.
+_end = object()
+
+class Stage():
+    """Description of one stage of a Pipeline.
+
+    The ``function`` is called for each input item and must return a
+    list of output items (which may be empty).  If ``init`` is given,
+    it is called once by each worker thread and its result is passed
+    to ``function`` as a second argument.  This can be used to give
+    each thread its own connections."""
+
+    def __init__(self, name, function, workers=1, init=None):
+        if workers < 1:
+            raise ValueError('Stage {} needs at least one worker'.format(name))
+
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.init = init
+
+class _StageState():
+    def __init__(self, workers):
+        self.lock = Lock()
+        self.results = {}
+        self.next_in = 0
+        self.next_out = 0
+        self.running = workers
+        self.failed = None
+
+class Pipeline():
+    """Chain of processing stages connected by bounded queues.
+
+    Items are read from the ``source`` iterable by a separate thread,
+    which therefore reads ahead by up to ``queue_size`` items.
+    Each stage is run by its own worker threads.  Where a stage has
+    several workers, its results are re-ordered before being passed on,
+    so the items leaving the pipeline are in the same order as those
+    entering it.
+
+    Iterating over the pipeline yields the output items of the last
+    stage.  If a stage raises an exception, the items which preceded
+    the failed item are still passed through the remaining stages, but
+    later items are discarded.  The exception is then re-raised by
+    the iteration."""
+
+    def __init__(self, source, stages, queue_size=16):
+        self.stages = stages
+        self.queues = [Queue(queue_size) for i in range(len(stages) + 1)]
+        self.error = None
+        self.failed_stage = None
+        self.aborted = False
+        self.drained = False
+        self.finished = False
+        self.threads = []
+        self.lock = Lock()
+
+        self._start(self._read, source)
+
+        for (index, stage) in enumerate(stages):
+            state = _StageState(stage.workers)
+
+            for i in range(stage.workers):
+                self._start(self._work, index, stage, state)
+
+    def __iter__(self):
+        try:
+            while True:
+                entry = self.queues[-1].get()
+
+                if entry is _end:
+                    self.drained = True
+                    break
+
+                yield entry[1]
+
+        finally:
+            self.close()
+
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Stop the pipeline, discarding any items not yet processed."""
+
+        if self.finished:
+            return
+
+        self.aborted = True
+
+        # Drain the final queue so that no worker is left blocked.
+        while not self.drained:
+            self.drained = self.queues[-1].get() is _end
+
+        for thread in self.threads:
+            thread.join()
+
+        self.finished = True
+
+    def _start(self, target, *args):
+        thread = Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def _abort(self, name, index, state=None, sequence=None):
+        logger.exception('Error in pipeline stage ' + name)
+
+        with self.lock:
+            if self.error is None:
+                self.error = sys.exc_info()[1]
+
+            if self.failed_stage is None or index < self.failed_stage:
+                self.failed_stage = index
+
+        if state is not None:
+            with state.lock:
+                if state.failed is None or sequence < state.failed:
+                    state.failed = sequence
+
+        self.aborted = True
+
+    def _skip(self, index, state, sequence):
+        """Determine whether an item should be discarded because
+        an earlier item failed."""
+
+        failed_stage = self.failed_stage
+
+        if failed_stage is None or index > failed_stage:
+            return False
+
+        if index < failed_stage:
+            return True
+
+        return state.failed is not None and sequence > state.failed
+
+    def _read(self, source):
+        queue = self.queues[0]
+        sequence = 0
+
+        try:
+            for item in source:
+                if self.aborted:
+                    break
+
+                queue.put((sequence, item))
+                sequence += 1
+
+        except Exception:
+            self._abort('source', -1)
+
+        finally:
+            for i in range(self.stages[0].workers if self.stages else 1):
+                queue.put(_end)
+
+    def _work(self, index, stage, state):
+        input_ = self.queues[index]
+        output = self.queues[index + 1]
+        context = None
+
+        try:
+            if stage.init is not None:
+                context = stage.init()
+
+        except Exception:
+            self._abort(stage.name, index, state, -1)
+
+        while True:
+            entry = input_.get()
+
+            if entry is _end:
+                break
+
+            (sequence, item) = entry
+            results = []
+
+            if not self._skip(index, state, sequence):
+                try:
+                    if stage.init is None:
+                        results = stage.function(item)
+                    else:
+                        results = stage.function(item, context)
+
+                except Exception:
+                    self._abort(stage.name, index, state, sequence)
+
+            # Pass on results in the order in which the items arrived.
+            with state.lock:
+                state.results[sequence] = results
+
+                while state.next_in in state.results:
+                    results = state.results.pop(state.next_in)
+
+                    if state.failed is not None and state.next_in > state.failed:
+                        results = []
+
+                    for result in results:
+                        output.put((state.next_out, result))
+                        state.next_out += 1
+
+                    state.next_in += 1
+
+        if hasattr(context, 'close'):
+            context.close()
+
+        with state.lock:
+            state.running -= 1
+            last = state.running == 0
+
+        if last:
+            next_index = index + 1
+            num_end = self.stages[next_index].workers \
+                if next_index < len(self.stages) else 1
+
+            for i in range(num_end):
+                output.put(_end)
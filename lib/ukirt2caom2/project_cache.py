@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+from contextlib import closing, contextmanager
+from logging import getLogger
+from os import stat
+import sqlite3
+from time import time
+
+from ukirt2caom2 import ProjectInfo
+
+logger = getLogger(__name__)
+
+class ProjectCache():
+    """Persistent cache of project information.
+
+    The information is stored in an SQLite database so that it can be
+    shared by all of the ingestion processes running on a node.  Entries
+    are considered valid for ``ttl`` seconds, or ``negative_ttl`` seconds
+    for projects which were not found.  If ``snapshot`` is set then
+    entries are used regardless of their age.
+
+    The database can also hold an index of the proposals file."""
+
+    def __init__(self, filename, ttl=7 * 86400, negative_ttl=86400,
+                 snapshot=False):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.snapshot = snapshot
+
+        # Use autocommit mode so that we can control the type of
+        # transaction.
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+
+        with self._transaction():
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                            'key TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS project ('
+                            'projectid TEXT PRIMARY KEY, '
+                            'title TEXT, pi TEXT, '
+                            'found INTEGER NOT NULL, '
+                            'fetched REAL NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS proposal ('
+                            'projectid TEXT PRIMARY KEY, '
+                            'title TEXT, pi TEXT)')
+
+    @contextmanager
+    def _transaction(self):
+        # Take the write lock immediately to avoid deadlocks between
+        # processes which read before they write.
+        self.db.execute('BEGIN IMMEDIATE')
+
+        try:
+            yield
+
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+
+        else:
+            self.db.execute('COMMIT')
+
+    def get_many(self, projectids):
+        """Looks up a number of projects.
+
+        Returns a dictionary containing a ProjectInfo object, or None for
+        projects known not to exist, for each project with a valid entry."""
+
+        result = {}
+        now = time()
+
+        with closing(self.db.cursor()) as c:
+            for projectid in projectids:
+                c.execute('SELECT title, pi, found, fetched FROM project '
+                          'WHERE projectid=?', (projectid,))
+                row = c.fetchone()
+
+                if row is None:
+                    continue
+
+                (title, pi, found, fetched) = row
+
+                if not self.snapshot:
+                    ttl = self.ttl if found else self.negative_ttl
+                    if fetched + ttl < now:
+                        continue
+
+                result[projectid] = ProjectInfo(_str(title), _str(pi)) \
+                    if found else None
+
+        return result
+
+    def put_many(self, projects):
+        """Store project information.
+
+        Takes a dictionary of ProjectInfo objects by project ID, where
+        None indicates that the project was not found."""
+
+        now = time()
+
+        with self._transaction():
+            for (projectid, info) in projects.items():
+                if info is None:
+                    values = (projectid, None, None, 0, now)
+                else:
+                    values = (projectid, info.title, info.pi, 1, now)
+
+                self.db.execute('INSERT OR REPLACE INTO project '
+                                '(projectid, title, pi, found, fetched) '
+                                'VALUES (?, ?, ?, ?, ?)', values)
+
+    def index_proposals(self, filename):
+        """Index the proposals file, unless it has not changed since
+        it was last indexed."""
+
+        info = stat(filename)
+        signature = '{} {} {}'.format(filename, info.st_size, info.st_mtime)
+
+        if self._get_meta('proposals') == signature:
+            return
+
+        with self._transaction():
+            # Check again in case another process just indexed the file.
+            if self._get_meta('proposals') == signature:
+                return
+
+            logger.info('Indexing proposals file ' + filename)
+
+            self.db.execute('DELETE FROM proposal')
+
+            with open(filename) as f:
+                for line in f:
+                    (projectid, name, title) = line.rstrip().split('\t', 3)
+                    self.db.execute('INSERT OR REPLACE INTO proposal '
+                                    '(projectid, title, pi) '
+                                    'VALUES (?, ?, ?)',
+                                    (projectid, title, name))
+
+            self.db.execute('INSERT OR REPLACE INTO meta (key, value) '
+                            'VALUES (?, ?)', ('proposals', signature))
+
+    def proposal_info(self, projectid):
+        """Look up a project in the proposals file index."""
+
+        with closing(self.db.cursor()) as c:
+            c.execute('SELECT title, pi FROM proposal WHERE projectid=?',
+                      (projectid,))
+            row = c.fetchone()
+
+        if row is None:
+            return None
+
+        return ProjectInfo(*map(_str, row))
+
+    def _get_meta(self, key):
+        with closing(self.db.cursor()) as c:
+            c.execute('SELECT value FROM meta WHERE key=?', (key,))
+            row = c.fetchone()
+
+        return None if row is None else row[0]
+
+def _str(value):
+    """SQLite returns unicode, but the rest of the ingestion
+    process expects ASCII strings."""
+
+    if value is None:
+        return None
+
+    return value.encode('ascii', 'replace')
+
+if __name__ == '__main__':
+    import sys
+    cache = ProjectCache(sys.argv[1], snapshot=True)
+    print(repr(cache.get_many(sys.argv[2:])))
@@ -6,12 +6,20 @@ import sys
 from ukirt2caom2 import ProjectInfo
 
 class Proposals():
-    """Class for reading project information from the proposals file."""
+    """Class for reading project information from the proposals file.
 
-    def __init__(self, file='data/projects.csv'):
+    If a ProjectCache is given, the file is indexed in the cache's
+    database rather than being read into memory."""
 
+    def __init__(self, file='data/projects.csv', cache=None):
+
+        self.cache = cache
         self.projects = {}
 
+        if cache is not None:
+            cache.index_proposals(file)
+            return
+
         with open(file) as f:
             for line in f:
                 (projectid, name, title) = line.rstrip().split('\t', 3)
@@ -19,9 +27,12 @@ class Proposals():
 
     def project_info(self, projectid):
         """Looks up relevant information about a project.
-        
+
         This will be a ProjectInfo object (a namedtuple)."""
 
+        if self.cache is not None:
+            return self.cache.proposal_info(projectid)
+
         return self.projects.get(projectid)
 
 if __name__ == '__main__':
@@ -1,17 +1,90 @@
-from datetime import datetime
+from datetime import date, datetime, timedelta
 
-from taco import Taco
+# Range of years covered by the semester calendar.
+first_year = 1975
+last_year = 2035
+
+# Semesters which do not follow the usual pattern, as a dictionary
+# of name: (first day, last day).  Any such semesters found using
+# the check mode of this module should be added here.
+semester_overrides = {
+}
+
+class SemesterCalendar():
+    """UKIRT semester calendar.
+
+    Semester "A" runs from the 2nd of February to the 1st of August and
+    semester "B" from the 2nd of August to the 1st of February, as in
+    OMP::DateTools.  The calendar is computed once, after which dates
+    can be looked up without further calculation."""
+
+    def __init__(self):
+        self.boundaries = {}
+
+        for year in range(first_year, last_year + 1):
+            self.boundaries['{:02d}A'.format(year % 100)] = \
+                (date(year, 2, 2), date(year, 8, 1))
+            self.boundaries['{:02d}B'.format(year % 100)] = \
+                (date(year, 8, 2), date(year + 1, 2, 1))
+
+        self.boundaries.update(semester_overrides)
+
+        # Map of day number to semester name.
+        self.days = {}
+
+        for semester in sorted(self.boundaries.keys(),
+                               key=lambda x: self.boundaries[x][0]):
+            (begin, end) = self.boundaries[semester]
+
+            for day in range(begin.toordinal(), end.toordinal() + 1):
+                self.days[day] = semester
+
+        # Data are released one year after the end of the semester.
+        self.releases = {}
+
+        for (semester, (begin, end)) in self.boundaries.items():
+            self.releases[semester] = datetime(end.year + 1, end.month,
+                                               end.day, 23, 59, 59)
+
+    def semester(self, date):
+        """Determine the semester in which the given date falls."""
+
+        try:
+            return self.days[date.toordinal()]
+
+        except KeyError:
+            raise Exception('Date {} outside semester calendar'.format(date))
+
+    def release(self, semester):
+        """Determine the release date for a given semester."""
+
+        return self.releases[semester]
+
+calendar = SemesterCalendar()
 
 class ReleaseCalculator():
+    def calculate(self, date):
+        return calendar.release(calendar.semester(date))
+
+class PerlReleaseCalculator():
+    """Release date calculator using OMP::DateTools.
+
+    This is used to check the SemesterCalendar."""
+
     def __init__(self):
+        from taco import Taco
+
         self.taco = Taco(lang='perl')
         self.taco.import_module('lib', '../omp-perl')
         self.taco.import_module('OMP::DateTools')
 
-    def calculate(self, date):
-        semester = self.taco.call_function(
+    def semester(self, date):
+        return self.taco.call_function(
             'OMP::DateTools::determine_semester', None,
             date=date.strftime('%Y%m%d'), tel='UKIRT')
+
+    def calculate(self, date):
+        semester = self.semester(date)
         (sem_begin, sem_end) = self.taco.call_function(
             'OMP::DateTools::semester_boundary', None,
             semester=semester, tel='UKIRT', context='list')
@@ -20,3 +93,52 @@ class ReleaseCalculator():
 
         return end_date.replace(year=end_date.year + 1,
                                 hour=23, minute=59, second=59)
+
+def check_calendar(start, end):
+    """Compare the SemesterCalendar with OMP::DateTools for each
+    day in the given range.
+
+    Returns the number of days for which they differ."""
+
+    perl = PerlReleaseCalculator()
+    python = ReleaseCalculator()
+
+    num_differences = 0
+    day = start
+
+    while day <= end:
+        expected = (perl.semester(day), perl.calculate(day))
+        found = (calendar.semester(day), python.calculate(day))
+
+        if found != expected:
+            print('{}: expected {} {}, found {} {}'.format(
+                  day.strftime('%Y%m%d'),
+                  expected[0], expected[1], found[0], found[1]))
+            num_differences += 1
+
+        day += timedelta(days=1)
+
+    return num_differences
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--check', required=False,
+                        default=False, action='store_true')
+    parser.add_argument('--start', required=False, default='19790101')
+    parser.add_argument('--end', required=False, default='20141231')
+    parser.add_argument('date', nargs='?', default=None)
+    args = parser.parse_args()
+
+    if args.check:
+        num_differences = check_calendar(
+            datetime.strptime(args.start, '%Y%m%d'),
+            datetime.strptime(args.end, '%Y%m%d'))
+
+        print('Number of differences: ' + str(num_differences))
+
+    elif args.date is not None:
+        day = datetime.strptime(args.date, '%Y%m%d')
+        print('{} {}'.format(calendar.semester(day),
+                             ReleaseCalculator().calculate(day)))
@@ -0,0 +1,59 @@
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+class RepoPresence():
+    """Set of CAOM-2 URIs known to be present in the repository.
+
+    This can be loaded from the repository's listing service or from
+    a local manifest file.  If a set of ``candidates`` (URIs) is
+    given then only those URIs are retained."""
+
+    def __init__(self, collection='UKIRT'):
+        self.collection = collection
+        self.uris = set()
+
+    def __contains__(self, uri):
+        return uri in self.uris
+
+    def __len__(self):
+        return len(self.uris)
+
+    def add(self, uri):
+        self.uris.add(uri)
+
+    def load_manifest(self, filename, candidates=None):
+        """Read a manifest file containing one URI per line.
+
+        Lines may contain either the full CAOM-2 URI or just the
+        observation ID."""
+
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+
+                if not line or line.startswith('#'):
+                    continue
+
+                self._add_candidate(self._uri(line), candidates)
+
+    def load_listing(self, connection, candidates=None, start=None, end=None):
+        """Read the listing of the collection from the repository
+        via a RepoConnection.
+
+        If ``start`` or ``end`` timestamps are given, only observations
+        last modified within that range are listed."""
+
+        for (observation_id, last_modified) in \
+                connection.list_observations(self.collection, start, end):
+            self._add_candidate(self._uri(observation_id), candidates)
+
+    def _uri(self, id_):
+        if id_.startswith('caom2:'):
+            return id_
+
+        return 'caom2:{}/{}'.format(self.collection, id_)
+
+    def _add_candidate(self, uri, candidates):
+        if candidates is None or uri in candidates:
+            self.uris.add(uri)
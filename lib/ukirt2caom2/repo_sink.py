@@ -0,0 +1,367 @@
+from collections import deque
+import errno
+from gzip import GzipFile
+import httplib
+from io import BytesIO
+from logging import getLogger
+import os
+from Queue import Queue
+import socket
+from threading import Event, Thread
+from urllib import urlencode
+from urlparse import urlparse
+
+from caom2repoClient.caom2repoClient import CAOM2RepoError, CAOM2RepoNotFound
+
+logger = getLogger(__name__)
+
+default_repo_url = 'https://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/caom2repo/pub'
+
+# Proxy certificate used by CAOM2RepoClient.
+default_certfile = os.path.join(os.path.expanduser('~'), '.ssl',
+                                'cadcproxy.pem')
+
+class RepoConflict(CAOM2RepoError):
+    """Raised when putting an observation which already exists."""
+
+    pass
+
+class RepoConnection():
+    """Connection to the CAOM-2 repository web service.
+
+    This provides the same methods as CAOM2RepoClient, but keeps its
+    HTTP(S) connection open between requests.  If ``gzip`` is set then
+    request bodies are compressed.
+
+    HTTPS connections use the given ``certfile``, or otherwise the
+    same certificate as CAOM2RepoClient, which must exist."""
+
+    def __init__(self, url=default_repo_url, certfile=None, gzip=False,
+                 timeout=120):
+        url = urlparse(url)
+
+        if url.scheme == 'https':
+            if certfile is None:
+                certfile = default_certfile
+
+            if not os.path.exists(certfile):
+                raise CAOM2RepoError(
+                    'Certificate file not found: ' + certfile)
+
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path.rstrip('/')
+        self.certfile = certfile
+        self.gzip = gzip
+        self.timeout = timeout
+        self.connection = None
+
+    def get_xml(self, uri):
+        (status, data) = self._request('GET', uri)
+
+        if status == 404:
+            raise CAOM2RepoNotFound('Observation not found: ' + uri)
+
+        elif status != 200:
+            raise CAOM2RepoError('Failed to get {}: HTTP {}'.format(uri, status))
+
+        return data
+
+    def put_xml(self, uri, xml):
+        (status, data) = self._request('PUT', uri, xml)
+
+        if status == 409:
+            raise RepoConflict('Observation already exists: ' + uri)
+
+        elif status not in (200, 201):
+            raise CAOM2RepoError('Failed to put {}: HTTP {}'.format(uri, status))
+
+    def update_xml(self, uri, xml):
+        (status, data) = self._request('POST', uri, xml)
+
+        if status == 404:
+            raise CAOM2RepoNotFound('Observation not found: ' + uri)
+
+        elif status not in (200, 201):
+            raise CAOM2RepoError('Failed to update {}: HTTP {}'.format(uri, status))
+
+    def remove(self, uri):
+        (status, data) = self._request('DELETE', uri)
+
+        if status == 404:
+            raise CAOM2RepoNotFound('Observation not found: ' + uri)
+
+        elif status not in (200, 204):
+            raise CAOM2RepoError('Failed to remove {}: HTTP {}'.format(uri, status))
+
+    def list_observations(self, collection, start=None, end=None,
+                          maxrec=10000, max_maxrec=1000000):
+        """List the observations in a collection.
+
+        Uses the repository's listing service, which returns observations
+        in order of modification, fetching ``maxrec`` at a time.  If
+        ``start`` or ``end`` timestamps are given, only observations last
+        modified within that range are listed.  This is a generator
+        yielding (observation ID, last modified) pairs, which may repeat
+        some entries.
+
+        If a whole batch has the same modification time, the listing is
+        repeated with a larger ``maxrec`` (up to ``max_maxrec``) so that
+        it can advance.  If that fails, CAOM2RepoError is raised, since
+        the listing would be incomplete."""
+
+        while True:
+            query = {'maxrec': maxrec}
+            if start is not None:
+                query['start'] = start
+            if end is not None:
+                query['end'] = end
+
+            (status, data) = self._request(
+                'GET', 'caom2:{}?{}'.format(collection, urlencode(query)))
+
+            if status != 200:
+                raise CAOM2RepoError('Failed to list {}: HTTP {}'.format(
+                                     collection, status))
+
+            num_rows = 0
+            last_modified = None
+
+            for line in data.splitlines():
+                if not line:
+                    continue
+
+                (row_collection, observation_id, last_modified) = \
+                    line.split('\t')[:3]
+                num_rows += 1
+
+                yield (observation_id, last_modified)
+
+            if num_rows < maxrec:
+                break
+
+            if last_modified == start:
+                if maxrec >= max_maxrec:
+                    raise CAOM2RepoError(
+                        'Repository listing did not advance past {}'
+                        .format(start))
+
+                maxrec = min(maxrec * 10, max_maxrec)
+                logger.warning('Repository listing did not advance past {}, '
+                               'retrying with maxrec {}'.format(start, maxrec))
+
+            start = last_modified
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _connect(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(
+                self.host, self.port, key_file=self.certfile,
+                cert_file=self.certfile, timeout=self.timeout)
+
+        else:
+            return httplib.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+
+    def _request(self, method, uri, body=None):
+        if not uri.startswith('caom2:'):
+            raise CAOM2RepoError('Invalid CAOM-2 URI: ' + uri)
+
+        path = self.path + '/' + uri[6:]
+        headers = {}
+
+        if body is not None:
+            headers['Content-Type'] = 'text/xml'
+
+            if self.gzip:
+                buff = BytesIO()
+                with GzipFile(fileobj=buff, mode='wb') as f:
+                    f.write(body)
+                body = buff.getvalue()
+                headers['Content-Encoding'] = 'gzip'
+
+        # If the server closed the kept-alive connection, reconnect
+        # and try once more.  Requests are only repeated if the server
+        # closed the connection without responding, since they might
+        # otherwise already have been applied.
+        for attempt in (1, 2):
+            reused = self.connection is not None
+
+            if not reused:
+                self.connection = self._connect()
+
+            sent = False
+
+            try:
+                self.connection.request(method, path, body, headers)
+                sent = True
+                response = self.connection.getresponse()
+                data = response.read()
+
+            except (httplib.HTTPException, socket.error) as e:
+                self.close()
+
+                retry = reused and (not sent or _closed_without_response(e))
+
+                if attempt == 2 or not retry:
+                    raise CAOM2RepoError('HTTP error for {}: {}'.format(
+                                         uri, str(e)))
+
+                continue
+
+            if response.getheader('connection', '').lower() == 'close':
+                self.close()
+
+            return (response.status, data)
+
+def _closed_without_response(e):
+    """Determine whether an exception raised while waiting for a
+    response indicates that the server closed the connection
+    without sending anything."""
+
+    if isinstance(e, httplib.BadStatusLine):
+        return not e.line or e.line == "''"
+
+    return isinstance(e, socket.error) and \
+        e.errno in (errno.ECONNRESET, errno.EPIPE)
+
+class _Request():
+    def __init__(self, method, uri, xml, callback):
+        self.method = method
+        self.uri = uri
+        self.xml = xml
+        self.callback = callback
+        self.error = None
+        self.done = Event()
+
+class RepoSink():
+    """Sends observations to the CAOM-2 repository using a pool
+    of threads.
+
+    Each thread has its own connection, created by calling
+    ``connection_factory``.  At most ``max_in_flight`` requests
+    may be outstanding: once this limit is reached, ``submit`` waits
+    for the oldest to complete.
+
+    The callback given for each request is called with the error message
+    (or None if successful) in the thread using the sink, and in the
+    order in which the requests were submitted."""
+
+    def __init__(self, connection_factory, num_workers=4, max_in_flight=None):
+        if max_in_flight is None:
+            max_in_flight = 2 * num_workers
+
+        self.max_in_flight = max_in_flight
+        self.pending = deque()
+        self.queue = Queue()
+        self.workers = []
+
+        for i in range(num_workers):
+            worker = Thread(target=self._worker, args=(connection_factory(),))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, uri, xml, update, callback):
+        """Queue an observation to be sent to the repository.
+
+        The ``update`` argument determines whether the observation
+        is updated, or put as a new observation."""
+
+        while len(self.pending) >= self.max_in_flight:
+            self._deliver(wait_first=True)
+
+        request = _Request('update' if update else 'put', uri, xml, callback)
+        self.pending.append(request)
+        self.queue.put(request)
+
+        self._deliver()
+
+    def complete(self, callback, error=None):
+        """Add an entry which is already complete.
+
+        This can be used for observations which are not being sent to the
+        repository so that their callbacks are called in order with
+        those of observations which were."""
+
+        request = _Request(None, None, None, callback)
+        request.error = error
+        request.done.set()
+        self.pending.append(request)
+
+        self._deliver()
+
+    def flush(self):
+        """Wait for all outstanding requests to complete."""
+
+        while self.pending:
+            self._deliver(wait_first=True)
+
+    def close(self):
+        self.flush()
+
+        for worker in self.workers:
+            self.queue.put(None)
+
+        for worker in self.workers:
+            worker.join()
+
+    def _deliver(self, wait_first=False):
+        """Call the callbacks for requests which are complete, stopping
+        at the first request which is not.  If ``wait_first`` is set
+        then wait for the first request to be complete."""
+
+        while self.pending:
+            request = self.pending[0]
+
+            if wait_first:
+                request.done.wait()
+                wait_first = False
+
+            elif not request.done.is_set():
+                break
+
+            self.pending.popleft()
+            request.callback(request.error)
+
+    def _worker(self, connection):
+        while True:
+            request = self.queue.get()
+
+            if request is None:
+                break
+
+            try:
+                if request.method == 'update':
+                    logger.debug('Updating in CAOM-2: ' + request.uri)
+                    connection.update_xml(request.uri, request.xml)
+
+                else:
+                    logger.debug('Putting to CAOM-2: ' + request.uri)
+
+                    try:
+                        connection.put_xml(request.uri, request.xml)
+
+                    except RepoConflict:
+                        logger.warning('Already in CAOM-2, updating: ' +
+                                       request.uri)
+                        connection.update_xml(request.uri, request.xml)
+
+            except CAOM2RepoError:
+                request.error = 'Failed to send to CAOM-2 repository'
+
+            except Exception as e:
+                logger.exception('Unexpected error sending ' + request.uri)
+                request.error = 'Failed to send to CAOM-2 repository: ' + str(e)
+
+            finally:
+                # Release the XML as soon as possible.
+                request.xml = None
+                request.done.set()
+
+        connection.close()
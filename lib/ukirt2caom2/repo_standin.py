@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""Local stand-in for the CAOM-2 repository web service.
+
+This implements GET, PUT, POST and DELETE of observation XML in memory
+in the same way as the caom2repo endpoints, so that the RepoSink can
+be tried without sending anything to CADC.  A GET request with a query
+string lists a collection, like the repository's listing service.
+For example:
+
+    python -m ukirt2caom2.repo_standin --port 8080
+    scripts/ukirt2caom2 -r --repo-url http://localhost:8080/caom2repo/pub ...
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime
+from gzip import GzipFile
+from io import BytesIO
+from SocketServer import ThreadingMixIn
+from threading import Lock, Thread
+from urlparse import parse_qs
+
+observations = {}
+observations_lock = Lock()
+
+# Last modification timestamp of each observation, in the format
+# used by the listing service.
+modified = {}
+
+# Log of (method, key) for each request received, so that the requests
+# made by a client can be checked.
+requests = []
+requests_lock = Lock()
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Allow connections to be kept alive.
+    protocol_version = 'HTTP/1.1'
+
+    # Set to respond to updates (POST) with an error, as the
+    # repository might if it does not accept the new version.
+    reject_updates = False
+
+    def do_GET(self):
+        if '?' in self.path:
+            self._list()
+            return
+
+        with observations_lock:
+            xml = observations.get(self._key())
+
+        if xml is None:
+            self._respond(404)
+        else:
+            self._respond(200, xml)
+
+    def do_PUT(self):
+        xml = self._body()
+        key = self._key()
+
+        with observations_lock:
+            if key in observations:
+                status = 409
+            else:
+                observations[key] = xml
+                modified[key] = _timestamp()
+                status = 200
+
+        self._respond(status)
+
+    def do_POST(self):
+        xml = self._body()
+        key = self._key()
+
+        with observations_lock:
+            if self.reject_updates:
+                status = 400
+            elif key not in observations:
+                status = 404
+            else:
+                observations[key] = xml
+                modified[key] = _timestamp()
+                status = 200
+
+        self._respond(status)
+
+    def do_DELETE(self):
+        key = self._key()
+
+        with observations_lock:
+            modified.pop(key, None)
+            status = 200 if observations.pop(key, None) else 404
+
+        self._respond(status)
+
+    def _list(self):
+        """List observations in a collection, in order of modification,
+        as tab-separated collection, observation ID and timestamp."""
+
+        (path, query) = self.path.split('?', 1)
+        collection = path.rstrip('/').split('/')[-1]
+        query = dict((k, v[0]) for (k, v) in parse_qs(query).items())
+        start = query.get('start')
+        end = query.get('end')
+        maxrec = int(query.get('maxrec', 10000))
+
+        with requests_lock:
+            requests.append(('LIST', collection))
+
+        with observations_lock:
+            rows = sorted(
+                (timestamp, key.split('/', 1)[1])
+                for (key, timestamp) in modified.items()
+                if key.split('/', 1)[0] == collection
+                and (start is None or timestamp >= start)
+                and (end is None or timestamp <= end))
+
+        body = ''.join('{}\t{}\t{}\n'.format(collection, id_, timestamp)
+                       for (timestamp, id_) in rows[:maxrec])
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/tab-separated-values')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _key(self):
+        # Use the last two path components: collection/observationID.
+        key = '/'.join(self.path.rstrip('/').split('/')[-2:])
+
+        with requests_lock:
+            requests.append((self.command, key))
+
+        return key
+
+    def _body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if self.headers.get('Content-Encoding') == 'gzip':
+            with GzipFile(fileobj=BytesIO(body)) as f:
+                body = f.read()
+
+        return body
+
+    def _respond(self, status, body=''):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_standin(port=0):
+    """Start a stand-in server in a background thread.
+
+    If no port is given, a free port is chosen.  Returns the server,
+    which should be stopped with its ``shutdown`` method, and the URL
+    to use for the repository service."""
+
+    server = StandInServer(('localhost', port), StandInHandler)
+
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return (server, 'http://localhost:{}/caom2repo/pub'.format(
+                    server.server_address[1]))
+
+def reset_standin():
+    """Remove all stored observations and logged requests."""
+
+    with observations_lock:
+        observations.clear()
+        modified.clear()
+
+    with requests_lock:
+        del requests[:]
+
+    StandInHandler.reject_updates = False
+
+def _timestamp():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    StandInServer(('localhost', args.port), StandInHandler).serve_forever()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+from contextlib import closing
+from logging import getLogger
+from os.path import exists, getmtime
+import sqlite3
+from threading import RLock
+from time import time
+
+logger = getLogger(__name__)
+
+status_ok = 'ok'
+status_error = 'error'
+
+class IngestionState():
+    """Record of the ingestion status of each file.
+
+    This is stored in an SQLite database (in WAL mode) in which
+    each file has a status, timestamp, error message and the
+    fingerprint of the observation as ingested.  Updates
+    are committed in batches of ``commit_interval`` records.
+
+    The ``in`` operator can be used to check whether a file has
+    been successfully ingested.  The object can be shared between
+    threads.
+
+    If ``read_only`` is set, the database must already exist, and
+    it is only queried: the table is not created or upgraded and
+    any attempt to record a result fails."""
+
+    def __init__(self, filename, commit_interval=100, read_only=False):
+        if read_only and not exists(filename):
+            raise Exception(
+                'Ingestion state file {} does not exist'.format(filename))
+
+        if exists(filename):
+            # Check that we have not been given an old control text file.
+            with open(filename, 'rb') as f:
+                magic = f.read(16)
+
+            if magic and magic != 'SQLite format 3\0':
+                raise Exception(
+                    'Ingestion state file {} is not an SQLite database: '
+                    'import control text files with '
+                    '"ukirt2caom2-db import-control"'.format(filename))
+
+        self.commit_interval = commit_interval
+        self.num_pending = 0
+        self.lock = RLock()
+
+        self.db = sqlite3.connect(filename, timeout=60,
+                                  check_same_thread=False)
+
+        if read_only:
+            self.db.execute('PRAGMA query_only=ON')
+            return
+
+        self.db.execute('PRAGMA journal_mode=WAL')
+
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS ingestion ('
+                            'filename TEXT PRIMARY KEY, '
+                            'status TEXT NOT NULL, '
+                            'timestamp REAL NOT NULL, '
+                            'message TEXT, '
+                            'fingerprint TEXT)')
+
+            # Add the fingerprint column to databases created before
+            # it was introduced.
+            columns = [x[1] for x in self.db.execute(
+                'PRAGMA table_info(ingestion)')]
+
+            if 'fingerprint' not in columns:
+                self.db.execute('ALTER TABLE ingestion '
+                                'ADD COLUMN fingerprint TEXT')
+
+    def __contains__(self, filename):
+        return self.is_ingested(filename)
+
+    def is_ingested(self, filename):
+        """Determine whether a file was successfully ingested."""
+
+        with self.lock, closing(self.db.cursor()) as c:
+            c.execute('SELECT status FROM ingestion WHERE filename=?',
+                      (filename,))
+            row = c.fetchone()
+
+        return row is not None and row[0] == status_ok
+
+    def fingerprint(self, filename):
+        """Get the fingerprint with which a file was successfully
+        ingested, or None if it is not available."""
+
+        with self.lock, closing(self.db.cursor()) as c:
+            c.execute('SELECT fingerprint FROM ingestion '
+                      'WHERE filename=? AND status=?',
+                      (filename, status_ok))
+            row = c.fetchone()
+
+        return None if row is None else row[0]
+
+    def record(self, filename, message=None, fingerprint=None):
+        """Record the outcome of ingesting a file.
+
+        If an error ``message`` is given, the file is marked as having
+        failed, otherwise it is marked as successfully ingested."""
+
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO ingestion '
+                '(filename, status, timestamp, message, fingerprint) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (filename, status_ok if message is None else status_error,
+                 time(), message, fingerprint))
+
+            self.num_pending += 1
+
+            if self.num_pending >= self.commit_interval:
+                self.commit()
+
+    def commit(self):
+        """Commit any pending records."""
+
+        with self.lock:
+            self.db.commit()
+            self.num_pending = 0
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.db.close()
+
+    def counts(self):
+        """Get a dictionary of the number of files with each status."""
+
+        with closing(self.db.cursor()) as c:
+            c.execute('SELECT status, COUNT(*) FROM ingestion '
+                      'GROUP BY status')
+            return dict(c.fetchall())
+
+    def import_control_file(self, filename):
+        """Import the list of files from an old control text file.
+
+        The files are marked as successfully ingested, with the
+        modification time of the control file as the timestamp.
+        Files which already have a status are left unchanged, since
+        it will be more recent than that from the control file.
+        Returns the number of files imported."""
+
+        timestamp = getmtime(filename)
+        num_imported = 0
+
+        with self.db:
+            with open(filename) as f:
+                for line in f:
+                    line = line.strip()
+
+                    if not line:
+                        continue
+
+                    c = self.db.execute(
+                        'INSERT OR IGNORE INTO ingestion '
+                        '(filename, status, timestamp, message) '
+                        'VALUES (?, ?, ?, NULL)',
+                        (line, status_ok, timestamp))
+                    num_imported += c.rowcount
+
+        return num_imported
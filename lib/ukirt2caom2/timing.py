@@ -0,0 +1,188 @@
+from contextlib import contextmanager
+import json
+from logging import getLogger
+from math import ceil
+from threading import Lock
+from time import time
+
+logger = getLogger(__name__)
+
+# Stages of ingestion, in the order in which they are reported.
+stages = (
+    'mongo', 'normalize', 'translate', 'project', 'release', 'build',
+    'write', 'repo_get', 'repo_put',
+)
+
+percentiles = (50, 90, 99)
+
+class StageTimer():
+    """Records the time spent in each stage of ingestion for each
+    observation.
+
+    Times are accumulated by observation key (the file name) and stage
+    name.  The timer can be shared between threads."""
+
+    def __init__(self):
+        self.records = {}
+        self.lock = Lock()
+
+    def add(self, key, stage, seconds):
+        with self.lock:
+            record = self.records.get(key)
+
+            if record is None:
+                record = self.records[key] = {}
+
+            record[stage] = record.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def time(self, key, stage):
+        start = time()
+
+        try:
+            yield
+
+        finally:
+            self.add(key, stage, time() - start)
+
+    def iterate(self, iterable, stage, key):
+        """Iterate over a sequence, recording the time taken to obtain
+        each item under the key given by calling ``key`` on the item."""
+
+        iterator = iter(iterable)
+
+        while True:
+            start = time()
+
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+
+            self.add(key(item), stage, time() - start)
+
+            yield item
+
+    def take(self):
+        """Return the records, clearing them from this timer."""
+
+        with self.lock:
+            (records, self.records) = (self.records, {})
+
+        return records
+
+    def merge(self, records):
+        """Add records returned by another timer's ``take`` method."""
+
+        for (key, record) in records.items():
+            for (stage, seconds) in record.items():
+                self.add(key, stage, seconds)
+
+    def summary(self, slowest=10):
+        """Summarize the recorded times.
+
+        Returns a dictionary giving, for each stage, the total, mean,
+        percentiles and maximum time per observation, and a list of the
+        ``slowest`` observations."""
+
+        with self.lock:
+            records = dict(self.records)
+
+        summary = {
+            'observations': len(records),
+            'total': sum(sum(x.values()) for x in records.values()),
+            'stages': {},
+        }
+
+        for stage in stages:
+            times = sorted(x[stage] for x in records.values() if stage in x)
+
+            if not times:
+                continue
+
+            stage_summary = {
+                'count': len(times),
+                'total': sum(times),
+                'mean': sum(times) / len(times),
+                'max': times[-1],
+            }
+
+            for percentile in percentiles:
+                stage_summary['p{}'.format(percentile)] = \
+                    _percentile(times, percentile)
+
+            summary['stages'][stage] = stage_summary
+
+        summary['slowest'] = [
+            {'filename': key, 'total': sum(record.values()), 'stages': record}
+            for (key, record) in sorted(
+                records.items(), key=lambda x: sum(x[1].values()),
+                reverse=True)[:slowest]]
+
+        return summary
+
+    def report(self, filename=None, slowest=10):
+        """Log a summary of the recorded times, and save it as JSON
+        if a file name is given."""
+
+        summary = self.summary(slowest)
+
+        logger.info('Timing for {} observations, total {:.1f} s'.format(
+                    summary['observations'], summary['total']))
+
+        for stage in stages:
+            if stage not in summary['stages']:
+                continue
+
+            info = summary['stages'][stage]
+            logger.info(
+                '{:10} total {:9.2f} s  mean {:8.1f} ms  '
+                'p50 {:8.1f} ms  p90 {:8.1f} ms  p99 {:8.1f} ms  '
+                'max {:8.1f} ms'.format(
+                    stage, info['total'], 1000 * info['mean'],
+                    1000 * info['p50'], 1000 * info['p90'],
+                    1000 * info['p99'], 1000 * info['max']))
+
+        for entry in summary['slowest']:
+            logger.info('Slow observation {}: {:.1f} ms'.format(
+                        entry['filename'], 1000 * entry['total']))
+
+        if filename is not None:
+            with open(filename, 'w') as f:
+                json.dump(summary, f, indent=2, sort_keys=True)
+
+        return summary
+
+class NullTimer():
+    """Timer which does nothing, used when timing is switched off."""
+
+    def add(self, key, stage, seconds):
+        pass
+
+    def time(self, key, stage):
+        return _null_context
+
+    def iterate(self, iterable, stage, key):
+        return iterable
+
+    def take(self):
+        return {}
+
+    def merge(self, records):
+        pass
+
+class _NullContext():
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type_, value, traceback):
+        return False
+
+_null_context = _NullContext()
+
+def _percentile(values, percentile):
+    """Nearest-rank percentile of a sorted list."""
+
+    index = int(ceil(percentile / 100.0 * len(values))) - 1
+
+    return values[max(0, min(len(values) - 1, index))]
@@ -1,3 +1,7 @@
+from os import kill, waitpid
+from os.path import abspath, dirname, join
+from signal import SIGKILL
+
 from taco import Taco
 
 class TranslationError(Exception):
@@ -6,7 +10,42 @@ class TranslationError(Exception):
 class Translator():
     def __init__(self):
         self.taco = Taco(lang='perl')
+        self.taco.import_module('lib', join(dirname(abspath(__file__)), 'perl'))
         self.taco.import_module('Astro::FITS::HdrTrans', 'translate_from_FITS')
+        self.taco.import_module('UKIRT2CAOM2::HdrTrans', 'translate_many')
+
+        # Taco does not keep its Popen object, so ask the interpreter
+        # for its process ID in case it has to be stopped.
+        self.pid = int(self.taco.get_value('$$'))
+
+    def version(self):
+        """Get the version of HdrTrans in use."""
+
+        return self.taco.get_value('$Astro::FITS::HdrTrans::VERSION')
+
+    def close(self):
+        """Close the connection to the Perl interpreter, which should
+        then exit.
+
+        This must not be called while a call is in progress in another
+        thread: use ``kill`` in that case."""
+
+        for stream in (self.taco.xp.out, self.taco.xp.in_):
+            stream.close()
+
+    def kill(self):
+        """Stop the Perl interpreter immediately.
+
+        A call in progress in another thread will then fail, as the
+        interpreter's output is closed."""
+
+        try:
+            kill(self.pid, SIGKILL)
+            waitpid(self.pid, 0)
+
+        except OSError:
+            # The process has already exited (and been reaped).
+            pass
 
     def translate(self, header):
         try:
@@ -17,3 +56,27 @@ class Translator():
             raise TranslationError(str(e))
 
         return header
+
+    def translate_many(self, headers, cards=None):
+        """Translate a list of headers with a single call to HdrTrans.
+
+        If a collection of card names is given, only those cards
+        are sent.
+
+        Returns a list in the same order as the given headers.  Each
+        entry is either the translated header, or a TranslationError
+        object if that header could not be translated.  An exception
+        is only raised if the call as a whole fails."""
+
+        if cards is not None:
+            headers = [dict((k, v) for (k, v) in header.items() if k in cards)
+                       for header in headers]
+
+        try:
+            results = self.taco.call_function('translate_many', headers)
+
+        except Exception as e:
+            raise TranslationError(str(e))
+
+        return [TranslationError(x['error']) if 'error' in x
+                else x['translated'] for x in results]
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+from contextlib import closing
+import cPickle as pickle
+from hashlib import sha1
+import json
+from logging import getLogger
+import sqlite3
+from threading import Lock
+from time import time
+
+from ukirt2caom2.translate import TranslationError
+
+logger = getLogger(__name__)
+
+# Increment this if the way in which entries are stored changes.
+cache_format = 2
+
+# Types of translated values which can be stored in the cache.  Other
+# values (e.g. Perl objects) are not stored.
+cacheable_types = (str, unicode, int, long, float, bool, type(None))
+
+def header_hash(header):
+    """Compute a stable hash of a header dictionary."""
+
+    return sha1(json.dumps(header, sort_keys=True, separators=(',', ':'),
+                           default=repr)).hexdigest()
+
+def cacheable_translation(translated):
+    """Restrict a translated header to the values which can be cached."""
+
+    return dict((k, v) for (k, v) in translated.items()
+                if isinstance(v, cacheable_types))
+
+class TranslationCache():
+    """Persistent cache of header translations.
+
+    Entries are stored in an SQLite database, keyed by a hash of the
+    header which was translated.  Translated headers are pickled so that
+    the types of their values (e.g. str or unicode) are preserved.
+    Translations which failed are stored with their error message so
+    that they don't need to be attempted again.
+
+    Each entry records the time at which it was last used.  The times
+    of entries found are updated in batches of ``touch_interval``
+    (or when entries are added).  When the number of entries exceeds
+    ``max_entries``, the least recently used are removed, leaving
+    a fraction ``evict_fraction`` of the limit free.  The number of
+    entries is kept as a running count, which is only checked against
+    the database when it appears to exceed the limit, since other
+    processes may share the cache.
+
+    The cache is cleared if it was written for a different ``version``
+    (e.g. of HdrTrans) to the one given."""
+
+    def __init__(self, filename, version, max_entries=2000000,
+                 touch_interval=1000, evict_fraction=0.1):
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.evict_fraction = evict_fraction
+        self.touched = {}
+        self.db = sqlite3.connect(filename, timeout=60,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                            'key TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS translation ('
+                            'hash TEXT PRIMARY KEY, '
+                            'translated BLOB, error TEXT, '
+                            'used REAL NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS translation_used '
+                            'ON translation (used)')
+
+        version = '{}:{}'.format(cache_format, version)
+
+        if self._get_meta('version') != version:
+            logger.info('Translation cache version changed, clearing')
+            self.clear()
+            with self.db:
+                self._set_meta('version', version)
+
+        self.num_entries = self._count()
+
+    def _get_meta(self, key):
+        with closing(self.db.cursor()) as c:
+            c.execute('SELECT value FROM meta WHERE key=?', (key,))
+            row = c.fetchone()
+
+        return None if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) '
+                        'VALUES (?, ?)', (key, str(value)))
+
+    def _count(self):
+        with closing(self.db.cursor()) as c:
+            c.execute('SELECT COUNT(*) FROM translation')
+            return c.fetchone()[0]
+
+    def clear(self):
+        """Remove all entries from the cache."""
+
+        with self.db:
+            self.db.execute('DELETE FROM translation')
+
+        self.touched = {}
+        self.num_entries = 0
+
+    def get_many(self, keys):
+        """Look up a list of hashes.
+
+        Returns a dictionary of results found, in which each value is
+        either the translated header or a TranslationError."""
+
+        results = {}
+
+        with closing(self.db.cursor()) as c:
+            for key in keys:
+                c.execute('SELECT translated, error FROM translation '
+                          'WHERE hash=?', (key,))
+                row = c.fetchone()
+
+                if row is None:
+                    continue
+
+                (translated, error) = row
+
+                if error is not None:
+                    results[key] = TranslationError(error.encode('utf-8'))
+                else:
+                    results[key] = pickle.loads(str(translated))
+
+        if results:
+            now = time()
+
+            for key in results:
+                self.touched[key] = now
+
+            if len(self.touched) >= self.touch_interval:
+                with self.db:
+                    self._touch()
+
+        return results
+
+    def put_many(self, entries):
+        """Store a list of (hash, result) pairs, where each result is
+        either a translated header or a TranslationError."""
+
+        now = time()
+
+        with self.db:
+            self._touch()
+
+            for (key, result) in entries:
+                if isinstance(result, TranslationError):
+                    (translated, error) = (None, str(result))
+                else:
+                    (translated, error) = (sqlite3.Binary(pickle.dumps(
+                        result, pickle.HIGHEST_PROTOCOL)), None)
+
+                c = self.db.execute('INSERT OR IGNORE INTO translation '
+                                    '(hash, translated, error, used) '
+                                    'VALUES (?, ?, ?, ?)',
+                                    (key, translated, error, now))
+
+                if c.rowcount:
+                    self.num_entries += 1
+
+                else:
+                    self.db.execute('UPDATE translation '
+                                    'SET translated=?, error=?, used=? '
+                                    'WHERE hash=?',
+                                    (translated, error, now, key))
+
+            if self.num_entries > self.max_entries:
+                self._evict()
+
+    def flush(self):
+        """Record the use of entries which have been found."""
+
+        if self.touched:
+            with self.db:
+                self._touch()
+
+    def _touch(self):
+        self.db.executemany('UPDATE translation SET used=? WHERE hash=?',
+                            [(used, key) for (key, used)
+                             in self.touched.items()])
+        self.touched = {}
+
+    def _evict(self):
+        self.num_entries = self._count()
+
+        excess = self.num_entries - int(
+            self.max_entries * (1.0 - self.evict_fraction))
+
+        if self.num_entries > self.max_entries and excess > 0:
+            logger.debug('Removing {} entries from translation cache'.format(
+                         excess))
+            self.db.execute('DELETE FROM translation WHERE hash IN ('
+                            'SELECT hash FROM translation '
+                            'ORDER BY used LIMIT ?)', (excess,))
+            self.num_entries -= excess
+
+class CachingTranslator():
+    """Translator wrapper which consults a TranslationCache.
+
+    Only headers not found in the cache are passed on to the
+    underlying translator.  Translated headers are always restricted
+    to cacheable values so that results do not depend on whether
+    the cache was hit.
+
+    The cache is locked while in use, so that this translator can be
+    shared between threads if the underlying translator can be."""
+
+    def __init__(self, translator, filename, **kwargs):
+        self.translator = translator
+        self.lock = Lock()
+        self.cache = TranslationCache(filename, translator.version(), **kwargs)
+
+    def version(self):
+        return self.translator.version()
+
+    def translate(self, header):
+        result = self.translate_many([header])[0]
+
+        if isinstance(result, TranslationError):
+            raise result
+
+        return result
+
+    def flush(self):
+        """Record the use of cache entries which have been found."""
+
+        with self.lock:
+            self.cache.flush()
+
+    def close(self):
+        self.flush()
+        self.translator.close()
+
+    def translate_many(self, headers, cards=None):
+        if cards is not None:
+            headers = [dict((k, v) for (k, v) in header.items() if k in cards)
+                       for header in headers]
+
+        keys = [header_hash(header) for header in headers]
+        with self.lock:
+            cached = self.cache.get_many(set(keys))
+
+        missing = [i for (i, key) in enumerate(keys) if key not in cached]
+
+        logger.debug('Translation cache: {} found, {} missing'.format(
+                     len(keys) - len(missing), len(missing)))
+
+        if missing:
+            results = self.translator.translate_many(
+                [headers[i] for i in missing])
+
+            new_entries = []
+
+            for (i, result) in zip(missing, results):
+                if not isinstance(result, TranslationError):
+                    result = cacheable_translation(result)
+
+                cached[keys[i]] = result
+                new_entries.append((keys[i], result))
+
+            with self.lock:
+                self.cache.put_many(new_entries)
+
+        return [cached[key] for key in keys]
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('file')
+    parser.add_argument('--clear', required=False,
+                        default=False, action='store_true')
+    args = parser.parse_args()
+
+    db = sqlite3.connect(args.file)
+
+    if args.clear:
+        with db:
+            db.execute('DELETE FROM translation')
+
+    with closing(db.cursor()) as c:
+        c.execute('SELECT value FROM meta WHERE key=?', ('version',))
+        print('Version: ' + repr(c.fetchone()))
+        c.execute('SELECT COUNT(*), COUNT(error) FROM translation')
+        print('Entries (failures): {} ({})'.format(*c.fetchone()))
@@ -0,0 +1,282 @@
+from logging import getLogger
+from Queue import Queue
+from threading import Event, Lock, Thread
+from time import time
+
+from ukirt2caom2.translate import TranslationError, Translator
+
+logger = getLogger(__name__)
+
+# Placed on a worker's queue to wake a thread whose translator
+# has been replaced.
+_wake = object()
+
+class _Request():
+    def __init__(self, function):
+        self.function = function
+        self.worker = None
+        self.translator = None
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self.start_time = None
+        self.started = Event()
+        self.done = Event()
+
+class _Worker():
+    """One translator and the thread which uses it."""
+
+    def __init__(self, index):
+        self.index = index
+        self.queue = Queue()
+        self.translator = None
+        self.thread = None
+        self.pending = 0
+        self.busy = False
+        self.restarts = 0
+
+class TranslatorPool():
+    """Pool of header translators, each with its own Perl interpreter.
+
+    Each translator is used by a dedicated thread, which takes requests
+    from its own queue.  Calls to ``translate_many`` are divided between
+    the translators, so the pool can be used in place of a Translator
+    object, and may be shared between threads.
+
+    If a call fails as a whole (e.g. because the Perl process died) or
+    does not complete within ``timeout`` seconds of being taken from
+    the queue by a worker, the interpreter is
+    killed and replaced by a new one.  Failed calls are then attempted
+    again, up to ``retries`` times, on another worker.  Calls which
+    timed out are not retried, since they would be likely to time out
+    again."""
+
+    def __init__(self, num_workers=4, timeout=300, retries=1, min_batch=10,
+                 translator_factory=Translator):
+        if num_workers < 1:
+            raise ValueError('The translator pool needs at least one worker')
+
+        self.timeout = timeout
+        self.retries = retries
+        self.min_batch = min_batch
+        self.translator_factory = translator_factory
+        self.lock = Lock()
+        self.workers = []
+
+        for i in range(num_workers):
+            worker = _Worker(i)
+            self._start(worker)
+            self.workers.append(worker)
+
+    def version(self):
+        return self._wait(self._submit(
+            lambda translator: translator.version()))
+
+    def translate(self, header):
+        result = self.translate_many([header])[0]
+
+        if isinstance(result, TranslationError):
+            raise result
+
+        return result
+
+    def translate_many(self, headers, cards=None):
+        """Translate a list of headers, dividing it between the workers.
+
+        Returns a list in the same form as Translator.translate_many."""
+
+        if not headers:
+            return []
+
+        num_parts = max(1, min(len(self.workers),
+                               len(headers) // self.min_batch))
+        size = -(-len(headers) // num_parts)
+
+        requests = [
+            self._submit(lambda translator, part=headers[i:i + size]:
+                         translator.translate_many(part, cards))
+            for i in range(0, len(headers), size)]
+
+        results = []
+
+        for request in requests:
+            results.extend(self._wait(request))
+
+        return results
+
+    def queue_depths(self):
+        """Get the number of requests outstanding for each worker."""
+
+        with self.lock:
+            return [x.pending for x in self.workers]
+
+    def restart_counts(self):
+        """Get the number of times each worker's translator was replaced."""
+
+        with self.lock:
+            return [x.restarts for x in self.workers]
+
+    def close(self):
+        """Stop the worker threads and their Perl interpreters.
+
+        Interpreters which do not finish their current call within
+        the timeout are killed."""
+
+        for worker in self.workers:
+            worker.queue.put(None)
+
+        for worker in self.workers:
+            worker.thread.join(self.timeout)
+
+            if worker.thread.is_alive():
+                logger.warning('Translator {} did not stop, killing it'
+                               .format(worker.index))
+                worker.translator.kill()
+
+    def _submit(self, function, exclude=None):
+        """Queue a request for the worker with the fewest outstanding
+        requests (other than ``exclude``, if given)."""
+
+        request = _Request(function)
+
+        with self.lock:
+            worker = min((x for x in self.workers if x is not exclude),
+                         key=lambda x: x.pending)
+            worker.pending += 1
+
+        request.worker = worker
+        worker.queue.put(request)
+
+        return request
+
+    def _wait(self, request, retries=None):
+        if retries is None:
+            retries = self.retries
+
+        worker = request.worker
+
+        # Wait for a worker to take the request before starting the
+        # timeout, as it may be queued behind other requests.  (Waiting
+        # in intervals allows the wait to be interrupted.)
+        while not request.started.wait(60):
+            pass
+
+        remaining = request.start_time + self.timeout - time()
+
+        if not request.done.wait(max(remaining, 0)):
+            with self.lock:
+                request.cancelled = True
+                translator = request.translator or worker.translator
+
+            logger.warning('Translator {} timed out, restarting it'.format(
+                           worker.index))
+            self._restart(worker, translator)
+
+            raise TranslationError('Translation timed out')
+
+        elif request.error is not None:
+            logger.warning('Translator {} failed ({}), restarting it'.format(
+                           worker.index, request.error))
+            self._restart(worker, request.translator)
+
+            if retries > 0:
+                exclude = worker if len(self.workers) > 1 else None
+                return self._wait(self._submit(request.function, exclude),
+                                  retries - 1)
+
+            raise request.error
+
+        return request.result
+
+    def _start(self, worker):
+        translator = self.translator_factory()
+
+        with self.lock:
+            worker.translator = translator
+            worker.busy = False
+            worker.thread = Thread(target=self._work,
+                                   args=(worker, translator))
+            worker.thread.daemon = True
+            worker.thread.start()
+
+    def _restart(self, worker, translator):
+        """Replace the given translator of a worker, unless this has
+        already been done."""
+
+        with self.lock:
+            if translator is None or worker.translator is not translator:
+                return
+
+            worker.restarts += 1
+            worker.translator = None
+            thread = worker.thread
+
+            # The old thread will not count the end of its request.
+            if worker.busy:
+                worker.pending -= 1
+
+        # Killing the interpreter makes a call in progress fail, and
+        # the wake-up marker releases the thread if it is idle, so
+        # that the old thread notices that it has been replaced.
+        translator.kill()
+        worker.queue.put(_wake)
+        thread.join(self.timeout)
+
+        if thread.is_alive():
+            logger.warning('Translator {} thread did not stop'.format(
+                           worker.index))
+
+        else:
+            try:
+                translator.close()
+
+            except Exception:
+                logger.exception('Error closing translator')
+
+        self._start(worker)
+
+    def _work(self, worker, translator):
+        while True:
+            request = worker.queue.get()
+
+            with self.lock:
+                if worker.translator is not translator:
+                    # Replaced while waiting: pass any request on to
+                    # the thread which will use the queue.
+                    if request is not _wake:
+                        worker.queue.put(request)
+                    break
+
+                if request is _wake:
+                    continue
+
+                if request is None:
+                    translator.close()
+                    break
+
+                if request.cancelled:
+                    worker.pending -= 1
+                    continue
+
+                request.translator = translator
+                request.start_time = time()
+                request.started.set()
+                worker.busy = True
+
+            try:
+                request.result = request.function(translator)
+
+            except Exception as e:
+                request.error = e
+
+            with self.lock:
+                replaced = worker.translator is not translator
+
+                if not replaced:
+                    worker.pending -= 1
+                    worker.busy = False
+
+            request.done.set()
+
+            if replaced:
+                break
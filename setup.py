@@ -11,8 +11,10 @@ setup(name='ukirt2caom2',
       description='UKIRT 2 CAOM2',
       package_dir={'': 'lib'},
       packages=['ukirt2caom2'],
+      package_data={'ukirt2caom2': ['perl/UKIRT2CAOM2/*.pm']},
       scripts=[os.path.join('scripts', script) for script in [
                    'ukirt2caom2',
+                   'ukirt2caom2-db',
                    'ukirt_archive_submit',
               ]],
       requires=[
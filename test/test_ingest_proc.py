@@ -0,0 +1,100 @@
+from os import close, remove
+from os.path import exists
+from tempfile import mkstemp
+from unittest import TestCase
+
+from ukirt2caom2 import repo_standin
+from ukirt2caom2.ingest_proc import IngestProc
+from ukirt2caom2.repo_sink import RepoConnection
+from ukirt2caom2.state import IngestionState
+
+key = 'UKIRT/ufti_20040101_5'
+uri = 'caom2:' + key
+
+files = [
+    'ukirt_ufti_20040101_5_reduced.fits',
+    'ukirt_ufti_20040101_5_reduced_preview_64.png',
+]
+
+files_changed = files + ['ukirt_ufti_20040101_5_mos.fits']
+
+class IngestProcTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        (cls.server, cls.url) = repo_standin.start_standin()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        repo_standin.reset_standin()
+
+        (fd, self.state_file) = mkstemp(suffix='.sqlite')
+        close(fd)
+
+        self.state = IngestionState(self.state_file)
+        self.ingest = IngestProc(
+            state=self.state,
+            client_factory=lambda: RepoConnection(self.url))
+
+    def tearDown(self):
+        self.state.close()
+
+        for suffix in ('', '-wal', '-shm'):
+            if exists(self.state_file + suffix):
+                remove(self.state_file + suffix)
+
+    def take_requests(self):
+        with repo_standin.requests_lock:
+            requests = list(repo_standin.requests)
+            del repo_standin.requests[:]
+
+        return requests
+
+    def test_new_observation(self):
+        self.ingest(files)
+
+        self.assertEqual(self.take_requests(), [('PUT', key)])
+        self.assertIn(key, repo_standin.observations)
+        self.assertIsNotNone(self.state.fingerprint(uri))
+
+    def test_unchanged(self):
+        self.ingest(files)
+        self.take_requests()
+
+        self.ingest(files)
+
+        self.assertEqual(self.take_requests(), [])
+
+    def test_changed(self):
+        self.ingest(files)
+        self.take_requests()
+        fingerprint = self.state.fingerprint(uri)
+
+        self.ingest(files_changed)
+
+        self.assertEqual(self.take_requests(), [('DELETE', key), ('PUT', key)])
+        self.assertIn('>mos<', repo_standin.observations[key])
+        self.assertNotEqual(self.state.fingerprint(uri), fingerprint)
+
+    def test_existing_not_in_state(self):
+        with repo_standin.observations_lock:
+            repo_standin.observations[key] = '<observation/>'
+
+        self.ingest(files)
+
+        self.assertEqual(self.take_requests(),
+                         [('PUT', key), ('DELETE', key), ('PUT', key)])
+        self.assertIn('>reduced<', repo_standin.observations[key])
+        self.assertIsNotNone(self.state.fingerprint(uri))
+
+    def test_without_state(self):
+        ingest = IngestProc(client_factory=lambda: RepoConnection(self.url))
+
+        ingest(files)
+        ingest(files)
+
+        self.assertEqual(self.take_requests(), [
+            ('DELETE', key), ('PUT', key), ('DELETE', key), ('PUT', key)])
@@ -0,0 +1,57 @@
+from os.path import abspath, dirname, join
+import sys
+from unittest import TestCase
+
+# The fakes used by the benchmarks stand in for the external services.
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'benchmarks'))
+
+import ukirt2caom2.instrument.ukirt
+
+from documents import header_document
+from fakes import FakeReleaseCalculator
+from ingestion import BenchmarkIngestRaw
+
+class FakeHeaderDB():
+    """Header database giving a fixed list of documents."""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def projects(self, instrument, date=None, obs_num=None):
+        return set(x['headers'][0]['PROJECT'] for x in self.docs)
+
+    def find(self, instrument, date, obs_num, fields=None, batch_size=None):
+        return iter(self.docs)
+
+class ObservationSummariesTestCase(TestCase):
+    def setUp(self):
+        ukirt2caom2.instrument.ukirt.release_calculator = \
+            FakeReleaseCalculator()
+
+        self.raw = BenchmarkIngestRaw()
+        self.raw.pipeline_chunk = 2
+
+    def summaries(self, docs):
+        self.raw.db = FakeHeaderDB(docs)
+
+        return list(self.raw.observation_summaries('ufti', '20030517'))
+
+    def test_summaries(self):
+        summaries = self.summaries(
+            [header_document('ufti', obs) for obs in range(1, 6)])
+
+        self.assertEqual([(x.date, x.obsnum) for x in summaries],
+                         [('20030517', obs) for obs in range(1, 6)])
+
+        for summary in summaries:
+            self.assertIsNotNone(summary.uri)
+
+    def test_duplicate(self):
+        # The duplicates straddle a chunk boundary.
+        docs = [header_document('ufti', obs) for obs in (1, 2, 2, 3)]
+        docs[2]['headers'][0]['RECIPE'] = 'REDUCE_FLAT'
+
+        summaries = self.summaries(docs)
+
+        self.assertEqual([x.obsnum for x in summaries], [1, 2, 3])
+        self.assertEqual(summaries[1].recipe, 'REDUCE_FLAT')
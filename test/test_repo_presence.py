@@ -0,0 +1,85 @@
+from unittest import TestCase
+
+from caom2repoClient.caom2repoClient import CAOM2RepoError
+
+from ukirt2caom2 import repo_standin
+from ukirt2caom2.repo_presence import RepoPresence
+from ukirt2caom2.repo_sink import RepoConnection
+
+# Observations in the stand-in repository, with their modification times.
+stored = [
+    ('f20030101_00001', '2003-01-02T08:00:00.000'),
+    ('f20030517_00001', '2003-05-18T09:00:00.000'),
+    ('f20030517_00002', '2003-05-18T09:00:01.000'),
+    ('f20030517_00003', '2010-02-03T10:00:00.000'),
+]
+
+class RepoPresenceTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        (cls.server, cls.url) = repo_standin.start_standin()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        repo_standin.reset_standin()
+
+        self.connection = RepoConnection(self.url)
+
+        for (id_, timestamp) in stored:
+            self.connection.put_xml('caom2:UKIRT/' + id_, '<observation/>')
+
+        with repo_standin.observations_lock:
+            for (id_, timestamp) in stored:
+                repo_standin.modified['UKIRT/' + id_] = timestamp
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_list_all(self):
+        listing = list(self.connection.list_observations('UKIRT', maxrec=2))
+
+        # Each page starts with the last entry of the previous page.
+        self.assertEqual(sorted(set(listing)), stored)
+
+    def test_list_range(self):
+        listing = list(self.connection.list_observations(
+            'UKIRT', start='2003-05-17T00:00:00.000',
+            end='2003-05-19T00:00:00.000'))
+
+        self.assertEqual(listing, stored[1:3])
+
+    def test_load_listing(self):
+        presence = RepoPresence('UKIRT')
+        candidates = set('caom2:UKIRT/f20030517_{:05d}'.format(x)
+                         for x in range(1, 5))
+
+        presence.load_listing(self.connection, candidates,
+                              start='2003-05-17T00:00:00.000')
+
+        self.assertEqual(sorted(presence.uris), [
+            'caom2:UKIRT/f20030517_00001',
+            'caom2:UKIRT/f20030517_00002',
+            'caom2:UKIRT/f20030517_00003',
+        ])
+        self.assertNotIn('caom2:UKIRT/f20030101_00001', presence)
+        self.assertNotIn('caom2:UKIRT/f20030517_00004', presence)
+
+    def test_list_same_timestamp(self):
+        with repo_standin.observations_lock:
+            for (id_, timestamp) in stored:
+                repo_standin.modified['UKIRT/' + id_] = stored[0][1]
+
+        # The batch size is increased so that the listing can advance.
+        listing = list(self.connection.list_observations(
+            'UKIRT', maxrec=2, max_maxrec=20))
+
+        self.assertEqual(sorted(set(x[0] for x in listing)),
+                         [x[0] for x in stored])
+
+        with self.assertRaises(CAOM2RepoError):
+            list(self.connection.list_observations(
+                'UKIRT', maxrec=2, max_maxrec=2))
@@ -0,0 +1,116 @@
+from threading import Lock
+from unittest import TestCase
+
+from caom2repoClient.caom2repoClient import CAOM2RepoError
+
+from ukirt2caom2 import repo_standin
+from ukirt2caom2.repo_sink import RepoConnection, RepoSink
+
+xml = '<observation>{}</observation>'
+
+class RepoSinkTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        (cls.server, cls.url) = repo_standin.start_standin()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        repo_standin.reset_standin()
+
+        self.outcomes = []
+        self.outcomes_lock = Lock()
+
+    def callback(self, name):
+        def record(error):
+            with self.outcomes_lock:
+                self.outcomes.append((name, error))
+
+        return record
+
+    def make_sink(self, gzip=False):
+        return RepoSink(lambda: RepoConnection(self.url, gzip=gzip),
+                        num_workers=3, max_in_flight=4)
+
+    def test_put(self):
+        for gzip in (False, True):
+            repo_standin.reset_standin()
+            del self.outcomes[:]
+
+            sink = self.make_sink(gzip)
+
+            for i in range(10):
+                sink.submit('caom2:UKIRT/obs_{}'.format(i), xml.format(i),
+                            False, self.callback(i))
+
+            sink.close()
+
+            # Callbacks are called in the order of submission.
+            self.assertEqual(self.outcomes, [(i, None) for i in range(10)])
+
+            for i in range(10):
+                self.assertEqual(
+                    repo_standin.observations['UKIRT/obs_{}'.format(i)],
+                    xml.format(i))
+
+    def test_update(self):
+        sink = self.make_sink()
+
+        sink.submit('caom2:UKIRT/obs_1', xml.format('old'), False,
+                    self.callback('put'))
+        sink.flush()
+
+        sink.submit('caom2:UKIRT/obs_1', xml.format('new'), True,
+                    self.callback('update'))
+        sink.submit('caom2:UKIRT/obs_2', xml.format('new'), True,
+                    self.callback('missing'))
+        sink.complete(self.callback('skipped'), 'not sent')
+        sink.close()
+
+        self.assertEqual(self.outcomes, [
+            ('put', None),
+            ('update', None),
+            ('missing', 'Failed to send to CAOM-2 repository'),
+            ('skipped', 'not sent'),
+        ])
+        self.assertEqual(repo_standin.observations['UKIRT/obs_1'],
+                         xml.format('new'))
+        self.assertNotIn('UKIRT/obs_2', repo_standin.observations)
+
+    def test_put_existing(self):
+        sink = self.make_sink()
+
+        sink.submit('caom2:UKIRT/obs_1', xml.format('old'), False,
+                    self.callback('put'))
+        sink.flush()
+
+        # Putting an observation which exists updates it instead.
+        sink.submit('caom2:UKIRT/obs_1', xml.format('new'), False,
+                    self.callback('put again'))
+        sink.close()
+
+        self.assertEqual(self.outcomes, [('put', None), ('put again', None)])
+        self.assertEqual(repo_standin.observations['UKIRT/obs_1'],
+                         xml.format('new'))
+
+    def test_keep_alive(self):
+        connection = RepoConnection(self.url)
+
+        try:
+            connection.put_xml('caom2:UKIRT/obs_1', xml.format(1))
+            first = connection.connection
+
+            self.assertEqual(connection.get_xml('caom2:UKIRT/obs_1'),
+                             xml.format(1))
+            self.assertIs(connection.connection, first)
+
+        finally:
+            connection.close()
+
+    def test_missing_certificate(self):
+        with self.assertRaises(CAOM2RepoError):
+            RepoConnection('https://localhost/caom2repo/pub',
+                           certfile='/nonexistent/cadcproxy.pem')